@@ -0,0 +1,116 @@
+"""Synthetic data archives for the benchmarks."""
+
+from __future__ import annotations
+
+import datetime
+import os
+import random
+from dataclasses import dataclass
+from pathlib import Path
+
+import toml
+
+
+@dataclass
+class Layout:
+    site: str
+    instrument: str
+    path_fmt: str
+    files_per_day: int
+    file_size: int
+
+    def paths(self, date: datetime.date) -> list[str]:
+        # Wildcards in path_fmt are filled with the file number, which is how
+        # e.g. hourly radar files or per-scan lidar directories look.
+        path = date.strftime(self.path_fmt)
+        if self.files_per_day == 1:
+            return [path.replace("*", "000000")]
+        return [path.replace("*", f"{i:02d}0000") for i in range(self.files_per_day)]
+
+
+def layouts(scale: str, n_sites: int = 4) -> list[Layout]:
+    """Archive layouts modelled on real instruments.
+
+    `small` is a handful of files, `many` has thousands of small files in deep
+    directory trees, and `large` has a few large files.
+    """
+    kib = 1024
+    mib = 1024 * kib
+    sizes = {
+        "small": (2, 8 * kib, 8 * kib),
+        "many": (48, 32 * kib, 16 * kib),
+        "large": (1, 64 * mib, 16 * mib),
+    }
+    n_files, radar_size, lidar_size = sizes[scale]
+    result = []
+    for i in range(n_sites):
+        site = f"site-{i:02d}"
+        result += [
+            Layout(
+                site=site,
+                instrument="rpg-fmcw-94",
+                path_fmt=f"data/{site}/rpg-fmcw-94/%Y/%m/%d/%y%m%d_*_P01_ZEN.LV0",
+                files_per_day=n_files,
+                file_size=radar_size,
+            ),
+            Layout(
+                site=site,
+                instrument="halo-doppler-lidar",
+                path_fmt=f"data/{site}/halo/%Y/%Y%m/%Y%m%d/*/Stare_%Y%m%d_*.hpl",
+                files_per_day=n_files,
+                file_size=lidar_size,
+            ),
+            Layout(
+                site=site,
+                instrument="chm15k",
+                path_fmt=f"data/{site}/chm15k/%Y/%m/%Y%m%d_{site}_CHM.nc",
+                files_per_day=1,
+                file_size=lidar_size,
+            ),
+        ]
+    return result
+
+
+def generate_archive(
+    root: Path, layouts: list[Layout], dates: list[datetime.date], seed: int = 0
+) -> list[Path]:
+    rnd = random.Random(seed)
+    block = rnd.randbytes(1024 * 1024) if hasattr(rnd, "randbytes") else None
+    paths = []
+    for layout in layouts:
+        for date in dates:
+            for path_str in layout.paths(date):
+                path = root / path_str
+                path.parent.mkdir(parents=True, exist_ok=True)
+                _write_file(path, layout.file_size, block)
+                paths.append(path)
+    return paths
+
+
+def _write_file(path: Path, size: int, block: bytes | None) -> None:
+    # Every file starts with unique bytes so that the checksums differ.
+    header = os.urandom(16)
+    with path.open("wb") as f:
+        f.write(header)
+        remaining = size - len(header)
+        while remaining > 0:
+            data = block if block is not None else os.urandom(1024 * 1024)
+            f.write(data[:remaining])
+            remaining -= len(data[:remaining])
+
+
+def write_config(path: Path, layouts: list[Layout]) -> Path:
+    config = {
+        "user_account": {"username": "bench", "password": "bench"},
+        "instrument": [
+            {
+                "site": layout.site,
+                "instrument": layout.instrument,
+                "instrument_pid": f"https://hdl.handle.net/{layout.site}",
+                "path_fmt": str(path.parent / layout.path_fmt),
+            }
+            for layout in layouts
+        ],
+    }
+    path.write_text(toml.dumps(config))
+    return path
@@ -0,0 +1,98 @@
+"""Compare the memory used by file records and eagerly built submissions.
+
+Example:
+    python -m benchmarks.memory --files 200000
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import gc
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+from cloudnet_submit.cfg import (
+    Config,
+    DataportalConfig,
+    InstrumentConfig,
+    ProxyConfig,
+    UserAccountConfig,
+)
+from cloudnet_submit.utils import FileRecord, make_submission
+
+
+def make_config() -> Config:
+    instrument = InstrumentConfig(
+        site="hyytiala",
+        instrument="rpg-fmcw-94",
+        instrument_pid="https://hdl.handle.net/21.12132/3.191564170f8a4686",
+        path_fmt="/data/hyytiala/rpg-fmcw-94/%Y/%m/%d/%y%m%d_*_P01_ZEN.LV0",
+        tags=None,
+        periodicity="daily",
+    )
+    return Config(
+        user_account=UserAccountConfig(username="hyytiala", password="secret"),
+        dataportal_config=DataportalConfig(base_url="http://localhost"),
+        proxy_config=ProxyConfig(),
+        instrument=[instrument],
+        model=[],
+        dry_run=True,
+        dates=[],
+    )
+
+
+def synthetic_files(config: Config, n_files: int):
+    conf = config.instrument[0]
+    start = datetime.date(2015, 1, 1)
+    for i in range(n_files):
+        date = start + datetime.timedelta(days=i // 96)
+        path = date.strftime(conf.path_fmt).replace("*", f"{i % 96:06d}")
+        yield path, date, conf
+
+
+def measure(build: Callable[[], list]) -> tuple[int, int]:
+    gc.collect()
+    tracemalloc.start()
+    items = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, len(items)
+
+
+def run(n_files: int) -> dict[str, int]:
+    config = make_config()
+    records = [
+        (path, date, conf, 8 * 1024 * 1024)
+        for path, date, conf in synthetic_files(config, n_files)
+    ]
+
+    def submissions() -> list:
+        return [
+            make_submission(config, date, conf, Path(path))
+            for path, date, conf, _ in records
+        ]
+
+    def file_records() -> list:
+        return [FileRecord(*record) for record in records]
+
+    before, _ = measure(submissions)
+    after, _ = measure(file_records)
+    return {"submissions": before, "records": after}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare memory used by file records and submissions."
+    )
+    parser.add_argument("--files", type=int, default=100_000)
+    args = parser.parse_args()
+    result = run(args.files)
+    for name, size in result.items():
+        print(f"{name:<12} {size / 1e6:8.1f} MB  {size / args.files:6.0f} bytes/file")
+    print(f"ratio        {result['submissions'] / result['records']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Portal:
+    """Local stand-in for the upload and file listing API of the data portal.
+
+    `latency` delays every response, `delays` the responses to one method,
+    e.g. `{"PUT": 1.0}`, `bandwidth` limits how fast request
+    bodies are received on each connection (bytes per second), and
+    `error_rate` is the fraction of POST and PUT requests answered with 503.
+    Responses in `injected` are sent to the next POST or PUT requests, and
+    those in `injected_by_method` to the next requests of one method.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, seed=0):
+        self.files: dict = {}
+        self.requests: list = []
+        self.listing_available = True
+        self.outage: int | None = None
+        self.injected: list[tuple[int, dict]] = []
+        self.injected_by_method: dict[str, list[tuple[int, dict]]] = {}
+        self.latency = latency
+        self.delays: dict[str, float] = {}
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.server = _Server(("127.0.0.1", 0), _make_handler(self))
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            daemon=True,
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_file(self, status="uploaded", **metadata) -> None:
+        with self.lock:
+            self.files[metadata["checksum"]] = {**metadata, "status": status}
+
+    def count(self, method: str) -> int:
+        with self.lock:
+            return sum(1 for m, _ in self.requests if m == method)
+
+
+class _Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients that time out close the connection before the reply is sent.
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def _make_handler(portal: Portal):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _record(self):
+            with portal.lock:
+                portal.requests.append((self.command, urlparse(self.path).path))
+            delay = portal.latency + portal.delays.get(self.command, 0.0)
+            if delay:
+                time.sleep(delay)
+
+        def _read(self, size: int) -> bytes:
+            if portal.bandwidth is None:
+                return self.rfile.read(size)
+            data = bytearray()
+            while len(data) < size:
+                block = self.rfile.read(min(64 * 1024, size - len(data)))
+                if not block:
+                    break
+                data.extend(block)
+                time.sleep(len(block) / portal.bandwidth)
+            return bytes(data)
+
+        def _reply(self, status: int, body="", content_type="text/plain", headers=None):
+            data = body.encode() if isinstance(body, str) else body
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_body(self) -> bytes:
+            if self.headers.get("Transfer-Encoding") == "chunked":
+                data = bytearray()
+                while size := int(self.rfile.readline().strip(), 16):
+                    data.extend(self._read(size))
+                    self.rfile.readline()
+                self.rfile.readline()
+            else:
+                data = self._read(int(self.headers.get("Content-Length", 0)))
+            return bytes(data)
+
+        def do_GET(self):
+            self._record()
+            url = urlparse(self.path)
+            kind = {"/api/raw-files": "instrument", "/api/raw-model-files": "model"}
+            if url.path not in kind or not portal.listing_available:
+                return self._reply(404, "Not Found")
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            with portal.lock:
+                files = [
+                    f
+                    for f in portal.files.values()
+                    if f["site"] == query.get("site")
+                    and f.get(kind[url.path]) == query.get(kind[url.path])
+                    and query["dateFrom"] <= f["measurementDate"] <= query["dateTo"]
+                ]
+            self._reply(200, json.dumps(files), "application/json")
+
+        def _inject(self) -> bool:
+            with portal.lock:
+                by_method = portal.injected_by_method.get(self.command)
+                if by_method:
+                    status, headers = by_method.pop(0)
+                elif portal.injected:
+                    status, headers = portal.injected.pop(0)
+                elif portal.outage is not None:
+                    status, headers = portal.outage, {}
+                elif portal.random.random() < portal.error_rate:
+                    status, headers = 503, {}
+                else:
+                    return False
+            self._read_body()
+            self._reply(status, "Service Unavailable", headers=headers)
+            return True
+
+        def do_POST(self):
+            self._record()
+            if self._inject():
+                return
+            if not self.path.endswith("/metadata"):
+                return self._reply(404, "Not Found")
+            metadata = json.loads(self._read_body())
+            with portal.lock:
+                existing = portal.files.get(metadata["checksum"])
+                if existing is not None and existing["status"] != "created":
+                    return self._reply(409, "File already exists")
+                portal.files[metadata["checksum"]] = {**metadata, "status": "created"}
+            self._reply(200, "OK")
+
+        def do_PUT(self):
+            self._record()
+            if self._inject():
+                return
+            checksum = urlparse(self.path).path.rsplit("/", 1)[-1]
+            data = self._read_body()
+            self._finish_upload(checksum, data)
+
+        def _finish_upload(self, checksum, data):
+            if hashlib.md5(data).hexdigest() != checksum:
+                return self._reply(400, "Checksum does not match file contents")
+            with portal.lock:
+                if checksum not in portal.files:
+                    return self._reply(400, "No metadata for checksum")
+                portal.files[checksum]["status"] = "uploaded"
+            self._reply(201, "Created")
+
+    return Handler
@@ -0,0 +1,278 @@
+"""Run benchmark scenarios and compare the results with earlier runs.
+
+Example:
+    python -m benchmarks.run --scale many --jobs 4 --latency 0.05
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from unittest.mock import patch
+
+from cloudnet_submit.cache import FileKey
+from cloudnet_submit.cfg import Config, get_config, parse_rate
+from cloudnet_submit.checksum import ChecksumEngine, compute_checksum
+from cloudnet_submit.client import open_checksum_cache
+from cloudnet_submit.main import main
+from cloudnet_submit.utils import iter_submissions
+from cloudnet_submit.validation import ValidationStats
+from cloudnet_submit.version import __version__
+
+from .archive import generate_archive, layouts, write_config
+from .portal import Portal
+
+SCENARIOS = ("scan", "validate", "hash", "upload", "full")
+RESULTS = Path(__file__).parent / "results.jsonl"
+SLOWER = 1.1
+
+
+@dataclass
+class Result:
+    scenario: str
+    params: dict
+    seconds: float
+    files: int
+    bytes: int
+    version: str = __version__
+    commit: str | None = None
+    timestamp: str = ""
+
+    def __str__(self) -> str:
+        rate = f"{self.files / self.seconds:9.1f} files/s"
+        if self.bytes:
+            rate += f" {self.bytes / 1e6 / self.seconds:9.1f} MB/s"
+        return f"{self.scenario:<8} {self.seconds:8.2f} s {rate}"
+
+
+@dataclass
+class Workspace:
+    root: Path
+    config_path: Path
+    paths: list[Path]
+    dates: list[datetime.date]
+
+    def argv(self, *args: str) -> list[str]:
+        return [
+            "cloudnet-submit",
+            "--config",
+            str(self.config_path),
+            "--from-date",
+            self.dates[0].isoformat(),
+            "--to-date",
+            self.dates[-1].isoformat(),
+            *args,
+        ]
+
+    def config(self, *args: str) -> Config:
+        with patch("sys.argv", self.argv(*args)):
+            config: Config = get_config()
+        return config
+
+
+def make_workspace(root: Path, scale: str, days: int, sites: int) -> Workspace:
+    today = datetime.datetime.now(tz=datetime.timezone.utc).date()
+    dates = [today - datetime.timedelta(days=i) for i in reversed(range(days))]
+    archive = layouts(scale, sites)
+    paths = generate_archive(root, archive, dates)
+    config_path = write_config(root / "cloudnet-config.toml", archive)
+    return Workspace(root, config_path, paths, dates)
+
+
+def run_scenario(name: str, ws: Workspace, params: dict) -> Result:
+    size = sum(path.stat().st_size for path in ws.paths)
+    start = time.perf_counter()
+    if name == "scan":
+        n_files = sum(1 for _ in iter_submissions(ws.config()))
+        return Result(name, params, time.perf_counter() - start, n_files, 0)
+    if name == "validate":
+        stats = ValidationStats()
+        for path in ws.paths:
+            stats.check(path)
+        return Result(name, params, time.perf_counter() - start, len(ws.paths), 0)
+    if name == "hash":
+        engine = ChecksumEngine(workers=params["hash_jobs"])
+        try:
+            engine.prefetch(ws.paths)
+            for path in ws.paths:
+                engine.checksum(path)
+        finally:
+            engine.close()
+        return Result(name, params, time.perf_counter() - start, len(ws.paths), size)
+    if name not in SCENARIOS:
+        raise ValueError(f"Unknown scenario: {name}")
+    args = ["--jobs", str(params["jobs"]), "--ignore-ledger"]
+    if name == "upload":
+        _warm_checksum_cache(ws)
+    else:
+        args.append("--no-cache")
+    portal = Portal(
+        latency=params["latency"],
+        bandwidth=params["bandwidth"],
+        error_rate=params["error_rate"],
+    )
+    portal.start()
+    try:
+        args += ["--host", portal.url]
+        start = time.perf_counter()
+        with patch("sys.argv", ws.argv(*args)), _quiet():
+            main()
+    except SystemExit:
+        pass  # Failed uploads are expected with error_rate > 0.
+    finally:
+        portal.stop()
+    return Result(name, params, time.perf_counter() - start, len(ws.paths), size)
+
+
+def _warm_checksum_cache(ws: Workspace) -> None:
+    cache = open_checksum_cache(ws.config())
+    if cache is None:
+        return
+    try:
+        for path in ws.paths:
+            cache.set(FileKey.from_path(path), compute_checksum(path))
+    finally:
+        cache.close()
+
+
+@contextlib.contextmanager
+def _quiet():
+    with open(os.devnull, "w") as devnull:
+        redirect = contextlib.redirect_stdout(devnull)
+        with redirect, patch("cloudnet_submit.submission.stdout", devnull):
+            yield
+
+
+def load_results(path: Path) -> list[Result]:
+    if not path.is_file():
+        return []
+    with path.open() as f:
+        return [Result(**json.loads(line)) for line in f if line.strip()]
+
+
+def save_results(path: Path, results: list[Result]) -> None:
+    with path.open("a") as f:
+        for result in results:
+            f.write(json.dumps(asdict(result)) + "\n")
+
+
+def compare(result: Result, history: list[Result]) -> str | None:
+    """Compare with the latest earlier result of the same benchmark."""
+    previous = [
+        old
+        for old in history
+        if old.scenario == result.scenario and old.params == result.params
+    ]
+    if not previous:
+        return None
+    old = previous[-1]
+    change = result.seconds / old.seconds
+    flag = "  SLOWER" if change > SLOWER else ""
+    label = old.version + (f" ({old.commit})" if old.commit else "")
+    return f"{change - 1:+7.1%} vs {label}{flag}"
+
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def get_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run cloudnet-submit benchmarks against a local portal."
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        default=list(SCENARIOS),
+        metavar="SCENARIO",
+        help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)",
+    )
+    parser.add_argument("--scale", choices=("small", "many", "large"), default="many")
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--sites", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--hash-jobs", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="portal response delay (s)"
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=parse_rate,
+        default=None,
+        help="portal receive rate per connection, e.g. 10Mbit/s",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="fraction of portal requests that fail with 503",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="report the best of N runs"
+    )
+    parser.add_argument("--results", type=Path, default=RESULTS)
+    parser.add_argument(
+        "--no-save", action="store_true", help="do not store the results"
+    )
+    return parser.parse_args(argv)
+
+
+def run(argv: list[str] | None = None) -> list[Result]:
+    args = get_args(argv)
+    params = {
+        "scale": args.scale,
+        "days": args.days,
+        "sites": args.sites,
+        "jobs": args.jobs,
+        "hash_jobs": args.hash_jobs,
+        "latency": args.latency,
+        "bandwidth": args.bandwidth,
+        "error_rate": args.error_rate,
+    }
+    history = load_results(args.results)
+    commit = git_commit()
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="cloudnet-submit-bench-") as tmp:
+        root = Path(tmp)
+        with patch.dict(os.environ, {"XDG_CACHE_HOME": str(root / "cache")}):
+            start = time.perf_counter()
+            ws = make_workspace(root, args.scale, args.days, args.sites)
+            print(
+                f"Generated {len(ws.paths)} files "
+                f"in {time.perf_counter() - start:.1f} s"
+            )
+            for name in args.scenarios:
+                runs = [run_scenario(name, ws, params) for _ in range(args.repeat)]
+                result = min(runs, key=lambda r: r.seconds)
+                result.commit = commit
+                result.timestamp = timestamp
+                comparison = compare(result, history)
+                print(f"{result}  {comparison}" if comparison else result)
+                results.append(result)
+    if not args.no_save:
+        save_results(args.results, results)
+    return results
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,114 @@
+"""Measure how quickly dry runs and configuration generation start.
+
+Example:
+    python -m benchmarks.startup --repeat 10
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from .archive import generate_archive, layouts, write_config
+
+# Modules that only the upload path needs.
+LAZY_MODULES = (
+    "braceexpand",
+    "concurrent.futures",
+    "ctypes",
+    "requests",
+    "sqlite3",
+    "urllib3",
+)
+
+
+@dataclass
+class Profile:
+    seconds: float
+    imports: dict[str, int]
+
+    @property
+    def import_seconds(self) -> float:
+        return self.imports.get("cloudnet_submit.main", 0) / 1e6
+
+    def unexpected(self) -> list[str]:
+        return [name for name in LAZY_MODULES if name in self.imports]
+
+
+def profile_command(args: list[str], cwd: Path, env: dict | None = None) -> Profile:
+    """Run cloudnet-submit with `python -X importtime`."""
+    cmd = [sys.executable, "-X", "importtime", "-m", "cloudnet_submit", *args]
+    start = time.perf_counter()
+    out = subprocess.run(
+        cmd,
+        cwd=cwd,
+        env={**os.environ, **(env or {})},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds = time.perf_counter() - start
+    imports = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        imports[name.strip()] = int(cumulative)
+    return Profile(seconds, imports)
+
+
+def profile_dry_run(config: Path, env: dict | None = None, repeat: int = 5):
+    """Profile repeated dry runs, returning the median time and last profile."""
+    args = ["--dry-run", "--config", str(config)]
+    profiles = [profile_command(args, config.parent, env) for _ in range(repeat)]
+    return statistics.median(p.seconds for p in profiles), profiles[-1]
+
+
+def report(name: str, seconds: float, profile: Profile) -> None:
+    print(
+        f"{name:<16} {seconds * 1000:7.1f} ms total, "
+        f"{profile.import_seconds * 1000:6.1f} ms importing cloudnet_submit"
+    )
+    for module in profile.unexpected():
+        print(f"  {module} imported ({profile.imports[module] / 1000:.1f} ms)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure start-up time of dry runs and --generate-config."
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    failed = False
+    with tempfile.TemporaryDirectory(prefix="cloudnet-submit-startup-") as tmp:
+        root = Path(tmp)
+        env = {"XDG_CACHE_HOME": str(root / "cache")}
+        archive = layouts("small", 1)
+        today = datetime.datetime.now(tz=datetime.timezone.utc).date()
+        generate_archive(root, archive, [today])
+        config = write_config(root / "cloudnet-config.toml", archive)
+        seconds, profile = profile_dry_run(config, env, args.repeat)
+        report("--dry-run", seconds, profile)
+        failed |= bool(profile.unexpected())
+        runs = []
+        for i in range(args.repeat):
+            target = root / f"generated-{i}.toml"
+            gen_args = ["--generate-config", "--config", str(target)]
+            runs.append(profile_command(gen_args, root, env))
+        seconds = statistics.median(p.seconds for p in runs)
+        report("--generate-config", seconds, runs[-1])
+        failed |= bool(runs[-1].unexpected())
+    if failed:
+        sys.exit("Modules of the upload path were imported at start-up.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,7 @@
 from cloudnet_submit.version import __version__ as __version__
+
+from .cfg import Config as Config
+from .cfg import load_configs as load_configs
+from .client import Client as Client
+from .client import SubmissionResult as SubmissionResult
+from .submission import Status as Status
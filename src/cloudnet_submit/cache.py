@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import datetime
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import sqlite3
+
+
+@dataclass(frozen=True)
+class FileKey:
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @classmethod
+    def from_path(cls, path: Path) -> FileKey:
+        stat = path.stat()
+        return cls(
+            path=str(path.resolve()),
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            inode=stat.st_ino,
+        )
+
+
+class ChecksumCache:
+    """Checksums of previously hashed files stored in SQLite."""
+
+    def __init__(self, path: Path, max_age: datetime.timedelta):
+        self.path = path
+        self._conn = connect(path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checksum ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, "
+                "checksum TEXT NOT NULL, accessed REAL NOT NULL)"
+            )
+        self.evict(max_age)
+
+    def get(self, key: FileKey) -> str | None:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT checksum FROM checksum "
+                "WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                (key.path, key.size, key.mtime_ns, key.inode),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE checksum SET accessed = ? WHERE path = ?",
+                (time.time(), key.path),
+            )
+        return str(row[0])
+
+    def set(self, key: FileKey, checksum: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checksum VALUES (?, ?, ?, ?, ?, ?)",
+                (key.path, key.size, key.mtime_ns, key.inode, checksum, time.time()),
+            )
+
+    def evict(self, max_age: datetime.timedelta) -> None:
+        cutoff = time.time() - max_age.total_seconds()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM checksum WHERE accessed < ?", (cutoff,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    import sqlite3  # noqa: PLC0415
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
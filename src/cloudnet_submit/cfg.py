@@ -2,14 +2,12 @@ from __future__ import annotations
 
 import argparse
 import datetime
+import os
 import re
 import sys
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from platform import platform
-from typing import Literal
-
-import toml
+from typing import Literal, Sequence
 
 from . import __version__
 from .generate_config import generate_config
@@ -23,9 +21,17 @@ class DataportalConfig:
         self.base_url: str = base_url
         self.instrument = self.Instrument(self.base_url)
         self.model = self.Model(self.base_url)
-        self.headers: dict[str, str] = {
-            "User-Agent": f"cloudnet-submit/{__version__} ({platform()})"
-        }
+        self._headers: dict[str, str] | None = None
+
+    @property
+    def headers(self) -> dict[str, str]:
+        if self._headers is None:
+            from platform import platform  # noqa: PLC0415
+
+            self._headers = {
+                "User-Agent": f"cloudnet-submit/{__version__} ({platform()})"
+            }
+        return self._headers
 
     def __str__(self) -> str:
         return f"DataportalConfig: base_url={self.base_url}"
@@ -34,6 +40,7 @@ class DataportalConfig:
         def __init__(self, base_url: str):
             self.base_url: str = base_url
             self.metadata_url: str = f"{self.base_url}/upload/metadata"
+            self.files_url: str = f"{self.base_url}/api/raw-files"
 
         def data_url(self, checksum: str) -> str:
             return f"{self.base_url}/upload/data/{checksum}"
@@ -42,6 +49,7 @@ class DataportalConfig:
         def __init__(self, base_url: str):
             self.base_url: str = base_url
             self.metadata_url: str = f"{self.base_url}/model-upload/metadata"
+            self.files_url: str = f"{self.base_url}/api/raw-model-files"
 
         def data_url(self, checksum: str) -> str:
             return f"{self.base_url}/model-upload/data/{checksum}"
@@ -62,6 +70,85 @@ class ProxyConfig:
         return asdict(self)
 
 
+@dataclass
+class BandwidthProfile:
+    start: datetime.time
+    end: datetime.time
+    limit: float | None
+
+    def active(self, now: datetime.time) -> bool:
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+
+@dataclass
+class BandwidthConfig:
+    limit: float | None = None
+    profiles: list[BandwidthProfile] = field(default_factory=list)
+
+    def current_limit(self, now: datetime.time) -> float | None:
+        for profile in self.profiles:
+            if profile.active(now):
+                return profile.limit
+        return self.limit
+
+
+@dataclass
+class CircuitBreakerConfig:
+    threshold: int = 5
+    min_backoff: float = 5.0
+    max_backoff: float = 300.0
+    max_retry_after: int = 3
+
+
+@dataclass
+class TimeoutConfig:
+    connect: float = 10.0
+    read: float = 120.0
+    min_rate: float | None = None
+    stall_time: float = 60.0
+    stall_retries: int = 2
+
+    @property
+    def requests(self) -> tuple[float, float]:
+        """Timeouts in the form accepted by `requests`."""
+        return self.connect, self.read
+
+
+@dataclass
+class StabilityConfig:
+    min_age: float = 0.0
+    probe: float = 0.0
+
+
+@dataclass
+class SpoolConfig:
+    enabled: bool = True
+    min_backoff: float = 600.0
+    max_backoff: float = 86400.0
+    max_attempts: int = 10
+
+
+@dataclass
+class MetricsConfig:
+    json: Path | None = None
+    textfile: Path | None = None
+
+
+@dataclass
+class CacheConfig:
+    enabled: bool
+    directory: Path
+    max_age_days: int
+
+
+@dataclass
+class UploadConfig:
+    single_read: bool = False
+    memory_threshold_mb: int = 64
+
+
 @dataclass
 class InstrumentConfig:
     site: str
@@ -70,9 +157,13 @@ class InstrumentConfig:
     path_fmt: str
     tags: list[str] | None
     periodicity: Literal["daily", "monthly"]
+    completion_marker: str | None = None
+    min_age: float | None = None
+    validate: Literal["warn", "defer"] | None = None
 
     def __post_init__(self):
         _validate_path_fmt(self.periodicity, self.path_fmt)
+        _validate_action(self.validate)
 
 
 @dataclass
@@ -80,9 +171,13 @@ class ModelConfig:
     site: str
     model: str
     path_fmt: str
+    completion_marker: str | None = None
+    min_age: float | None = None
+    validate: Literal["warn", "defer"] | None = None
 
     def __post_init__(self):
         _validate_path_fmt("daily", self.path_fmt)
+        _validate_action(self.validate)
 
 
 @dataclass
@@ -94,9 +189,25 @@ class Config:
     model: list[ModelConfig]
     dry_run: bool
     dates: list[datetime.date]
-
-
-def get_args():
+    jobs: int = 1
+    hash_jobs: int = 1
+    cache: CacheConfig | None = None
+    ignore_ledger: bool = False
+    upload: UploadConfig = field(default_factory=UploadConfig)
+    preflight: bool = True
+    watch: bool = False
+    settle: float = 5.0
+    bandwidth: BandwidthConfig = field(default_factory=BandwidthConfig)
+    circuit_breaker: CircuitBreakerConfig = field(default_factory=CircuitBreakerConfig)
+    metrics: MetricsConfig = field(default_factory=MetricsConfig)
+    shard: tuple[int, int] | None = None
+    stability: StabilityConfig = field(default_factory=StabilityConfig)
+    spool: SpoolConfig = field(default_factory=SpoolConfig)
+    timeouts: TimeoutConfig = field(default_factory=TimeoutConfig)
+    deadline: float | None = None
+
+
+def get_args(argv: Sequence[str] | None = None):
     parser = argparse.ArgumentParser(
         description="Submit data to the ACTRIS Cloudnet data portal.",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -108,6 +219,9 @@ Examples:
   cloudnet-submit -d 2024-01-15            # Submit specific date
   cloudnet-submit -l 7                     # Submit last 7 days
   cloudnet-submit --from-date 2024-01-01 --to-date 2024-01-31 # Submit date range
+  cloudnet-submit -j 8                     # Submit 8 files concurrently
+  cloudnet-submit --watch                  # Submit new files as they are written
+  cloudnet-submit -c stations/             # Submit all configurations in a directory
 """,
     )
     parser.add_argument(
@@ -122,8 +236,12 @@ Examples:
         "-c",
         "--config",
         type=str,
-        default=DEFAULT_CONFIG_FNAME,
-        help=f"path to configuration file (default: {DEFAULT_CONFIG_FNAME})",
+        nargs="+",
+        action="extend",
+        metavar="PATH",
+        help=f"path to configuration file (default: {DEFAULT_CONFIG_FNAME}). "
+        "several files, or directories of .toml files, are submitted in one "
+        "run.",
     )
     parser.add_argument(
         "-n",
@@ -175,7 +293,108 @@ Examples:
         help="override port for the data portal URL (appended to --host). "
         "default: standard HTTPS port (443).",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=jobs_arg,
+        default=1,
+        metavar="N",
+        help="number of files to submit concurrently (default: 1)",
+    )
+    parser.add_argument(
+        "--hash-jobs",
+        type=jobs_arg,
+        default=min(4, os.cpu_count() or 1),
+        metavar="N",
+        help="number of files to hash concurrently "
+        "(default: number of CPUs, at most 4)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="after submitting the given dates, keep running and submit files "
+        "as soon as they have been written",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=5.0,
+        metavar="SECONDS",
+        help="in --watch mode, wait until a file has not been written for "
+        "this many seconds before submitting it (default: 5)",
+    )
+    parser.add_argument(
+        "--min-age",
+        type=float,
+        metavar="SECONDS",
+        help="skip files modified less than this many seconds ago, so that "
+        "files still being written are submitted on a later run. overrides "
+        "min_age in the configuration file.",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        metavar="SECONDS",
+        help="stop starting new submissions this many seconds after the "
+        "start, and list the files left for the next run",
+    )
+    parser.add_argument(
+        "--no-preflight",
+        action="store_true",
+        help="do not list files already on the data portal before submitting",
+    )
+    parser.add_argument(
+        "--single-read",
+        action="store_true",
+        help="read each file only once, keeping a copy of it between hashing "
+        "and uploading (useful on network file systems)",
+    )
+    parser.add_argument(
+        "--limit-rate",
+        type=rate_arg,
+        metavar="RATE",
+        help="limit the total upload bandwidth, e.g. 500kB/s or 2Mbit/s. "
+        "overrides the bandwidth settings in the configuration file.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="do not use or update the local checksum cache and ledger",
+    )
+    parser.add_argument(
+        "--ignore-ledger",
+        action="store_true",
+        help="submit files even if they have already been submitted "
+        "according to the local ledger",
+    )
+    parser.add_argument(
+        "--no-spool",
+        action="store_true",
+        help="do not retry files that failed on earlier runs, and do not "
+        "remember the files that fail on this run",
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_arg,
+        metavar="I/N",
+        help="split the files into N parts by site, instrument or model, and "
+        "date, and submit only part I (1 <= I <= N). useful for sharing a "
+        "large backfill between several machines.",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        type=Path,
+        metavar="FILE",
+        help="write timings and counters of the run to FILE as JSON",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        type=Path,
+        metavar="FILE",
+        help="write timings and counters of the run to FILE for the "
+        "Prometheus node exporter textfile collector (use a .prom suffix)",
+    )
+    return parser.parse_args(argv)
 
 
 def last_ndays_arg(val):
@@ -185,20 +404,122 @@ def last_ndays_arg(val):
     return ndays
 
 
-def get_config():
+def rate_arg(val):
+    try:
+        return parse_rate(val)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err)) from err
+
+
+def parse_rate(val: str | float) -> float | None:
+    """Parse a bandwidth like "2 Mbit/s" or "500kB/s" to bytes per second."""
+    if isinstance(val, (int, float)):
+        rate = float(val)
+    elif val.strip() == "unlimited":
+        return None
+    else:
+        m = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([kMG]?)(bit|B)/s\s*", val)
+        if m is None:
+            raise ValueError(f"Invalid bandwidth: {val}")
+        prefix = {"": 1, "k": 1e3, "M": 1e6, "G": 1e9}[m.group(2)]
+        rate = float(m.group(1)) * prefix / (8 if m.group(3) == "bit" else 1)
+    if rate <= 0:
+        raise ValueError(f"Bandwidth must be positive: {val}")
+    return rate
+
+
+def parse_time(val: str | datetime.time) -> datetime.time:
+    """Parse a time of day like "08:00", or pass through a TOML local time."""
+    if isinstance(val, datetime.time):
+        return val
+    return datetime.time.fromisoformat(val)
+
+
+def jobs_arg(val):
+    jobs = int(val)
+    if jobs <= 0:
+        raise argparse.ArgumentTypeError(f"# of jobs must be positive: {jobs}")
+    return jobs
+
+
+def shard_arg(val):
+    match = re.fullmatch(r"(\d+)/(\d+)", val)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Invalid shard, expected I/N: {val}")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Shard must be between 1/N and N/N: {val}")
+    return index, count
+
+
+def get_config() -> Config:
+    """Return the configuration of the first configuration file."""
+    return get_configs()[0]
+
+
+def get_configs() -> list[Config]:
     args = get_args()
+    if args.config is None:
+        args.config = [DEFAULT_CONFIG_FNAME]
     if args.generate_config:
-        generate_config(EXAMPLE_CONFIG_FNAME, args.config)
-        print(f"Configuration file generated: {args.config}")
+        if len(args.config) > 1:
+            sys.stderr.write("Give only one --config with --generate-config.\n")
+            sys.exit(1)
+        generate_config(EXAMPLE_CONFIG_FNAME, args.config[0])
+        print(f"Configuration file generated: {args.config[0]}")
         sys.exit(0)
-
-    path = Path(args.config)
-    if not path.is_file():
-        sys.stderr.write(f'"{path}" does not exist. Cannot read the configuration.\n')
+    paths = get_config_paths(args.config)
+    if args.deadline is not None and args.watch:
+        sys.stderr.write("--deadline cannot be used with --watch.\n")
+        sys.exit(1)
+    if args.shard is not None and args.watch:
+        sys.stderr.write("--shard cannot be used with --watch.\n")
+        sys.exit(1)
+    if args.watch and len(paths) > 1:
+        sys.stderr.write("--watch supports only one configuration file.\n")
         sys.exit(1)
+    return [read_config(path, args) for path in paths]
+
+
+def load_configs(
+    paths: Sequence[str | Path], options: Sequence[str] = ()
+) -> list[Config]:
+    """Read configuration files for use from Python.
+
+    `options` are command-line options, e.g. `["--host", url, "--jobs", "4"]`.
+    Directories are expanded to the .toml files in them.
+    """
+    args = get_args(list(options))
+    config_paths = get_config_paths([str(path) for path in paths])
+    return [read_config(path, args) for path in config_paths]
+
+
+def get_config_paths(names: list[str]) -> list[Path]:
+    paths = []
+    for name in names:
+        path = Path(name)
+        if path.is_dir():
+            found = sorted(p for p in path.glob("*.toml") if p.is_file())
+            if not found:
+                sys.stderr.write(f'No configuration files in "{path}".\n')
+                sys.exit(1)
+            paths.extend(found)
+        elif path.is_file():
+            paths.append(path)
+        else:
+            sys.stderr.write(
+                f'"{path}" does not exist. Cannot read the configuration.\n'
+            )
+            sys.exit(1)
+    return paths
+
+
+def read_config(path: Path, args) -> Config:
+    import toml  # noqa: PLC0415
+
     config_toml = toml.load(path)
     base_url = args.host + (f":{args.port}" if args.port else "")
-    return Config(
+    config = Config(
         user_account=get_user_account_config(config_toml),
         dataportal_config=DataportalConfig(base_url=base_url),
         proxy_config=get_proxy_config(config_toml),
@@ -206,7 +527,24 @@ def get_config():
         model=get_model_config(config_toml),
         dry_run=args.dry_run,
         dates=get_dates(args),
+        jobs=args.jobs,
+        hash_jobs=args.hash_jobs,
+        cache=get_cache_config(config_toml, args),
+        ignore_ledger=args.ignore_ledger,
+        upload=get_upload_config(config_toml, args),
+        preflight=not args.no_preflight,
+        watch=args.watch,
+        settle=args.settle,
+        bandwidth=get_bandwidth_config(config_toml, args),
+        circuit_breaker=get_circuit_breaker_config(config_toml),
+        metrics=get_metrics_config(config_toml, args),
+        shard=args.shard,
+        stability=get_stability_config(config_toml, args),
+        spool=get_spool_config(config_toml, args),
+        timeouts=get_timeout_config(config_toml),
+        deadline=args.deadline,
     )
+    return config
 
 
 def get_proxy_config(config) -> ProxyConfig:
@@ -217,6 +555,104 @@ def get_proxy_config(config) -> ProxyConfig:
     )
 
 
+def get_cache_config(config, args) -> CacheConfig:
+    cache = config.get("cache", {})
+    directory = cache.get("directory", None)
+    return CacheConfig(
+        enabled=cache.get("enabled", True) and not args.no_cache,
+        directory=Path(directory).expanduser() if directory else default_cache_dir(),
+        max_age_days=cache.get("max_age_days", 30),
+    )
+
+
+def get_upload_config(config, args) -> UploadConfig:
+    upload = config.get("upload", {})
+    return UploadConfig(
+        single_read=upload.get("single_read", False) or args.single_read,
+        memory_threshold_mb=upload.get("memory_threshold_mb", 64),
+    )
+
+
+def default_cache_dir() -> Path:
+    if sys.platform == "win32" and "LOCALAPPDATA" in os.environ:
+        return Path(os.environ["LOCALAPPDATA"]) / "cloudnet-submit"
+    if "XDG_CACHE_HOME" in os.environ:
+        return Path(os.environ["XDG_CACHE_HOME"]) / "cloudnet-submit"
+    return Path.home() / ".cache" / "cloudnet-submit"
+
+
+def get_bandwidth_config(config, args) -> BandwidthConfig:
+    if args.limit_rate is not None:
+        return BandwidthConfig(limit=args.limit_rate)
+    network = config.get("network", {})
+    limit = network.get("bandwidth", None)
+    profiles = [
+        BandwidthProfile(
+            start=parse_time(profile["start"]),
+            end=parse_time(profile["end"]),
+            limit=parse_rate(profile["limit"]),
+        )
+        for profile in network.get("bandwidth_profile", [])
+    ]
+    return BandwidthConfig(
+        limit=parse_rate(limit) if limit is not None else None,
+        profiles=profiles,
+    )
+
+
+def get_circuit_breaker_config(config) -> CircuitBreakerConfig:
+    breaker = config.get("network", {}).get("circuit_breaker", {})
+    return CircuitBreakerConfig(
+        threshold=breaker.get("threshold", 5),
+        min_backoff=breaker.get("min_backoff", 5.0),
+        max_backoff=breaker.get("max_backoff", 300.0),
+        max_retry_after=breaker.get("max_retry_after", 3),
+    )
+
+
+def get_timeout_config(config) -> TimeoutConfig:
+    network = config.get("network", {})
+    min_rate = network.get("min_rate", None)
+    return TimeoutConfig(
+        connect=float(network.get("connect_timeout", 10.0)),
+        read=float(network.get("read_timeout", 120.0)),
+        min_rate=parse_rate(min_rate) if min_rate is not None else None,
+        stall_time=float(network.get("stall_time", 60.0)),
+        stall_retries=network.get("stall_retries", 2),
+    )
+
+
+def get_stability_config(config, args) -> StabilityConfig:
+    stability = config.get("stability", {})
+    min_age = args.min_age
+    if min_age is None:
+        min_age = stability.get("min_age", 0.0)
+    return StabilityConfig(
+        min_age=float(min_age),
+        probe=float(stability.get("probe", 0.0)),
+    )
+
+
+def get_spool_config(config, args) -> SpoolConfig:
+    spool = config.get("spool", {})
+    return SpoolConfig(
+        enabled=spool.get("enabled", True) and not args.no_spool,
+        min_backoff=spool.get("min_backoff", 600.0),
+        max_backoff=spool.get("max_backoff", 86400.0),
+        max_attempts=spool.get("max_attempts", 10),
+    )
+
+
+def get_metrics_config(config, args) -> MetricsConfig:
+    metrics = config.get("metrics", {})
+    json_path = args.metrics_json or metrics.get("json", None)
+    textfile = args.metrics_textfile or metrics.get("textfile", None)
+    return MetricsConfig(
+        json=Path(json_path).expanduser() if json_path else None,
+        textfile=Path(textfile).expanduser() if textfile else None,
+    )
+
+
 def get_user_account_config(config) -> UserAccountConfig:
     return UserAccountConfig(
         username=config["user_account"]["username"],
@@ -231,12 +667,15 @@ def get_instrument_config(config) -> list[InstrumentConfig]:
     for iconf in config["instrument"]:
         instrument_configs.append(
             InstrumentConfig(
-                site=iconf["site"],
-                instrument=iconf["instrument"],
+                site=sys.intern(iconf["site"]),
+                instrument=sys.intern(iconf["instrument"]),
                 instrument_pid=iconf["instrument_pid"],
                 path_fmt=iconf["path_fmt"],
                 tags=iconf.get("tags", None),
                 periodicity=iconf.get("periodicity", "daily"),
+                completion_marker=iconf.get("completion_marker", None),
+                min_age=iconf.get("min_age", None),
+                validate=get_validate_action(iconf),
             )
         )
     return instrument_configs
@@ -249,14 +688,26 @@ def get_model_config(config) -> list[ModelConfig]:
     for mconf in config["model"]:
         model_configs.append(
             ModelConfig(
-                site=mconf["site"],
-                model=mconf["model"],
+                site=sys.intern(mconf["site"]),
+                model=sys.intern(mconf["model"]),
                 path_fmt=mconf["path_fmt"],
+                completion_marker=mconf.get("completion_marker", None),
+                min_age=mconf.get("min_age", None),
+                validate=get_validate_action(mconf),
             )
         )
     return model_configs
 
 
+def get_validate_action(conf) -> Literal["warn", "defer"] | None:
+    action: Literal["warn", "defer"] | None = conf.get("validate", None)
+    if action is True:
+        return "defer"
+    if action is False:
+        return None
+    return action
+
+
 def get_dates(args) -> list[datetime.date]:
     today = datetime.datetime.now(tz=datetime.timezone.utc).date()
     one_day = datetime.timedelta(days=1)
@@ -309,3 +760,8 @@ def _validate_path_fmt(periodicity: Literal["daily", "monthly"], path_fmt: str)
         plural = "s" if len(invalid) != 1 else ""
         lst = ", ".join(invalid)
         raise ValueError(f"Unsupported directive{plural} in path_fmt: {lst}")
+
+
+def _validate_action(action: str | None) -> None:
+    if action not in (None, "warn", "defer"):
+        raise ValueError(f'validate must be "warn" or "defer", not {action!r}')
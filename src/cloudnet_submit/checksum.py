@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Iterable
+
+from .cache import ChecksumCache, FileKey
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from .metrics import Metrics
+
+BUFFER_SIZE = 1024 * 1024
+
+_local = threading.local()
+
+
+def compute_checksum(path: Path) -> str:
+    with path.open("rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "md5").hexdigest()
+        md5hash = hashlib.md5()
+        buffer = _buffer()
+        view = memoryview(buffer)
+        while n := f.readinto(buffer):
+            md5hash.update(view[:n])
+    return md5hash.hexdigest()
+
+
+def spool_file(path: Path, in_memory: bool) -> tuple[str, IO[bytes]]:
+    """Read a file once, returning its checksum and a rewindable copy.
+
+    The copy is kept in memory or written to a local temporary file.
+    """
+    md5hash = hashlib.md5()
+    spool: IO[bytes] = (
+        io.BytesIO() if in_memory else tempfile.TemporaryFile()  # noqa: SIM115
+    )
+    buffer = _buffer()
+    view = memoryview(buffer)
+    try:
+        with path.open("rb") as f:
+            while n := f.readinto(buffer):
+                md5hash.update(view[:n])
+                spool.write(view[:n])
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return md5hash.hexdigest(), spool
+
+
+def _buffer() -> bytearray:
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None:
+        buffer = _local.buffer = bytearray(BUFFER_SIZE)
+    return buffer
+
+
+class ChecksumEngine:
+    """Compute checksums in a thread pool ahead of the submissions.
+
+    hashlib releases the GIL while hashing large buffers, so threads are enough
+    to hash several files in parallel.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        cache: ChecksumCache | None = None,
+        single_read_threshold: int | None = None,
+        metrics: Metrics | None = None,
+    ):
+        self.cache = cache
+        self.metrics = metrics
+        self.single_read_threshold = single_read_threshold
+        from concurrent.futures import ThreadPoolExecutor  # noqa: PLC0415
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="checksum"
+        )
+        # A future is only reused while the file is unchanged, so a rewritten
+        # file is hashed again.
+        self._futures: dict[Path, tuple[FileKey, Future[str]]] = {}
+        self._lock = threading.Lock()
+        self.n_files = 0
+        self.n_bytes = 0
+        self._start: float | None = None
+        self._end: float | None = None
+
+    def prefetch(self, paths: Iterable[Path], site: str = "") -> None:
+        for path in paths:
+            try:
+                self._future(path, site)
+            except OSError:
+                # Reported when the checksum is needed.
+                continue
+
+    def checksum(self, path: Path, site: str = "") -> str:
+        future = self._future(path, site)
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._futures.pop(path, None)
+
+    def forget(self, path: Path) -> None:
+        """Drop the prefetched checksum of a file that is not submitted now."""
+        with self._lock:
+            entry = self._futures.pop(path, None)
+        if entry is not None:
+            entry[1].cancel()
+
+    def read_once(self, path: Path, site: str = "") -> tuple[str, IO[bytes] | None]:
+        """Return checksum and, unless cached, a copy of the file for upload."""
+        key = FileKey.from_path(path)
+        if self.cache is not None:
+            checksum = self.cache.get(key)
+            if checksum is not None:
+                return checksum, None
+        threshold = self.single_read_threshold
+        start = time.perf_counter()
+        checksum, payload = spool_file(
+            path, in_memory=threshold is None or key.size <= threshold
+        )
+        self._record(start, time.perf_counter(), key.size, site)
+        if self.cache is not None:
+            self.cache.set(key, checksum)
+        return checksum, payload
+
+    def report(self) -> str | None:
+        if self._start is None or self._end is None:
+            return None
+        elapsed = self._end - self._start
+        megabytes = self.n_bytes / 1e6
+        rate = megabytes / elapsed if elapsed > 0 else float("inf")
+        noun = "file" if self.n_files == 1 else "files"
+        return (
+            f"Hashed {self.n_files} {noun} ({megabytes:.1f} MB) "
+            f"in {elapsed:.1f} s, {rate:.1f} MB/s"
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            for _, future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown()
+
+    def _future(self, path: Path, site: str) -> Future[str]:
+        key = FileKey.from_path(path)
+        with self._lock:
+            entry = self._futures.get(path)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+            if entry is not None:
+                entry[1].cancel()
+            future = self._executor.submit(self._compute, path, key, site)
+            self._futures[path] = (key, future)
+        return future
+
+    def _compute(self, path: Path, key: FileKey, site: str) -> str:
+        if self.cache is not None:
+            checksum = self.cache.get(key)
+            if checksum is not None:
+                return checksum
+        start = time.perf_counter()
+        checksum = compute_checksum(path)
+        self._record(start, time.perf_counter(), key.size, site)
+        if self.cache is not None:
+            self.cache.set(key, checksum)
+        return checksum
+
+    def _record(self, start: float, end: float, size: int, site: str) -> None:
+        if self.metrics is not None:
+            self.metrics.add("hash", end - start, size, site=site)
+        with self._lock:
+            self.n_files += 1
+            self.n_bytes += size
+            if self._start is None or start < self._start:
+                self._start = start
+            if self._end is None or end > self._end:
+                self._end = end
@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import dataclasses
+import datetime
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator, Sequence
+
+from .cache import ChecksumCache
+from .cfg import Config, default_cache_dir
+from .checksum import ChecksumEngine
+from .health import HealthTracker
+from .ledger import Ledger
+from .metrics import Metrics
+from .pipeline import run_pipeline
+from .spool import RetrySpool
+from .submission import (
+    InstrumentMetadata,
+    ModelMetadata,
+    Status,
+    Submission,
+    SubmissionContext,
+)
+from .throttle import TokenBucket
+from .utils import FileRecord, Summary, iter_all_submissions
+
+if TYPE_CHECKING:
+    from .watch import Target
+
+
+@dataclass
+class SubmissionResult:
+    path: Path
+    metadata: InstrumentMetadata | ModelMetadata
+    status: Status
+
+    @property
+    def ok(self) -> bool:
+        """Whether the file is on the data portal after the submission."""
+        return self.status.ok and not self.status.deferred
+
+
+class Client:
+    """Submit files to the data portal from Python.
+
+    The client keeps connections, the checksum cache and the ledger open
+    between calls, so a long-running process can submit files without the
+    start-up cost of the command-line tool. Settings for the whole client,
+    like `jobs` and `[cache]`, come from the first configuration.
+
+    Each client has its own connections, circuit breaker and metrics, so
+    several clients can be open at once. Its methods can be called from
+    several threads, e.g. with `asyncio.to_thread`. The status of each file is
+    printed only if `verbose` is set.
+
+    Example:
+        configs = load_configs(["cloudnet-config.toml"])
+        with Client(configs) as client:
+            for result in client.submit_dates([datetime.date(2024, 1, 15)]):
+                print(result.path, result.ok, result.status.metadata_msg)
+    """
+
+    def __init__(
+        self,
+        configs: Config | Sequence[Config],
+        jobs: int | None = None,
+        verbose: bool = False,
+    ):
+        configs = [configs] if isinstance(configs, Config) else list(configs)
+        if not configs:
+            raise ValueError("No configuration given")
+        self.configs = configs
+        self.config = config = configs[0]
+        self.jobs = jobs or config.jobs
+        self.verbose = verbose
+        self.closed = False
+        self._targets: list[tuple[Config, list[Target]]] | None = None
+        self.metrics = Metrics()
+        self.context = SubmissionContext(
+            pool_size=self.jobs, timeouts=config.timeouts, verbose=verbose
+        )
+        self.context.metrics = self.metrics
+        self.checksum_cache: ChecksumCache | None = None
+        try:
+            self._setup(config)
+        except BaseException:
+            self.close()
+            raise
+
+    def _setup(self, config: Config) -> None:
+        context = self.context
+        self.checksum_cache = open_checksum_cache(config)
+        if config.upload.single_read:
+            threshold = config.upload.memory_threshold_mb * 1024 * 1024
+            self.engine = ChecksumEngine(
+                single_read_threshold=threshold,
+                cache=self.checksum_cache,
+                metrics=self.metrics,
+            )
+        else:
+            self.engine = ChecksumEngine(
+                config.hash_jobs, self.checksum_cache, metrics=self.metrics
+            )
+        context.checksum_engine = self.engine
+        context.bandwidth = TokenBucket.from_config(config.bandwidth)
+        context.health = HealthTracker(
+            threshold=config.circuit_breaker.threshold,
+            base_delay=config.circuit_breaker.min_backoff,
+            max_delay=config.circuit_breaker.max_backoff,
+            max_retries=config.circuit_breaker.max_retry_after,
+        )
+        if config.cache is not None and config.cache.enabled:
+            context.ledger = Ledger(
+                ledger_path(config), lookup=not config.ignore_ledger
+            )
+        if config.spool.enabled:
+            context.spool = RetrySpool(
+                spool_path(config),
+                min_backoff=config.spool.min_backoff,
+                max_backoff=config.spool.max_backoff,
+                max_attempts=config.spool.max_attempts,
+            )
+
+    def __enter__(self) -> Client:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def preflight(
+        self, configs: Sequence[Config] | None = None
+    ) -> set[tuple[str, str]] | None:
+        """List files already on the data portal, so they can be skipped.
+
+        Returns the sites and checksums of the files on the dates of `configs`,
+        by default the configurations of the client, or None if the data
+        portal could not list them. Pass the listing to `with_listing`.
+        """
+        configs = self.configs if configs is None else configs
+        uploaded = preflight(configs, self.context)
+        if uploaded is None and self.verbose:
+            print("Could not list files on the data portal, checking each file.")
+        return uploaded
+
+    def submit_dates(
+        self, dates: Iterable[datetime.date], jobs: int | None = None
+    ) -> list[SubmissionResult]:
+        """Submit the files of all instruments and models for the given dates."""
+        dates = sorted(set(dates))
+        configs = [dataclasses.replace(config, dates=dates) for config in self.configs]
+        uploaded = self.preflight(configs) if self.config.preflight else None
+        submissions = iter_all_submissions(configs, context=self.context)
+        return self.submit(with_listing(submissions, uploaded), jobs)
+
+    def submit_files(
+        self, paths: Iterable[str | os.PathLike], jobs: int | None = None
+    ) -> list[SubmissionResult]:
+        """Submit files, each matching the path_fmt of an instrument or model.
+
+        Raises ValueError before submitting anything if a file does not match.
+        """
+        submissions = [self.make_submission(path) for path in paths]
+        return self.submit(submissions, jobs)
+
+    def make_submission(self, path: str | os.PathLike) -> Submission:
+        """Return the submission of a file matching an instrument or model."""
+        config, record = self._match(path)
+        return record.submission(config, self.context)
+
+    def _match(self, path: str | os.PathLike) -> tuple[Config, FileRecord]:
+        from .watch import make_targets, match_record  # noqa: PLC0415
+
+        if self._targets is None:
+            self._targets = [(config, make_targets(config)) for config in self.configs]
+        abspath = os.path.abspath(path)
+        for config, targets in self._targets:
+            for target in targets:
+                record = match_record(target, abspath)
+                if record is not None:
+                    return config, record
+        raise ValueError(f"{path} does not match any instrument or model")
+
+    def spooled_submissions(self) -> list[Submission]:
+        """Return submissions of files that failed earlier and are due a retry.
+
+        Files that no longer exist are forgotten. Files that do not match any
+        configuration of the client, or belong to another `--shard`, are left
+        for other clients.
+        """
+        spool = self.context.spool
+        if spool is None:
+            return []
+        submissions = []
+        for entry in spool.due():
+            if not os.path.isfile(entry.path):
+                spool.remove(entry.path)
+                continue
+            try:
+                config, record = self._match(entry.path)
+            except ValueError:
+                continue
+            if config.shard is not None:
+                index, count = config.shard
+                if record.shard(count) != index - 1:
+                    continue
+            submissions.append(record.submission(config, self.context))
+        return submissions
+
+    def retry_spooled(self, jobs: int | None = None) -> list[SubmissionResult]:
+        """Submit files that failed earlier and are due a retry."""
+        return self.submit(self.spooled_submissions(), jobs)
+
+    def submit(
+        self, submissions: Iterable[Submission], jobs: int | None = None
+    ) -> list[SubmissionResult]:
+        """Submit files concurrently with `jobs` workers and return the results."""
+        if self.closed:
+            raise RuntimeError("Client is closed")
+        done: list[Submission] = []
+
+        def collect() -> Iterator[Submission]:
+            for sub in submissions:
+                done.append(sub)
+                yield sub
+
+        summary = Summary(dry_run=False)
+        run_pipeline(collect(), self.context, summary, jobs=jobs or self.jobs)
+        return [SubmissionResult(sub.path, sub.metadata, sub.status) for sub in done]
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        # The setup may have failed before everything was opened.
+        self.context.close()
+        if self.checksum_cache is not None:
+            self.checksum_cache.close()
+        self.metrics.finish()
+
+
+def with_listing(
+    submissions: Iterable[Submission], uploaded: set[tuple[str, str]] | None
+) -> Iterator[Submission]:
+    """Skip files found in a listing of the data portal, see `Client.preflight`."""
+    for sub in submissions:
+        sub.uploaded_checksums = uploaded
+        yield sub
+
+
+def preflight(
+    configs: Sequence[Config], context: SubmissionContext
+) -> set[tuple[str, str]] | None:
+    from .preflight import fetch_uploaded_checksums  # noqa: PLC0415
+
+    uploaded: set[tuple[str, str]] = set()
+    for config in configs:
+        session = context.session_pool(config.proxy_config).get()
+        listed = fetch_uploaded_checksums(config, session)
+        if listed is None:
+            return None
+        uploaded |= listed
+    return uploaded
+
+
+def open_checksum_cache(config: Config) -> ChecksumCache | None:
+    if config.cache is None or not config.cache.enabled:
+        return None
+    return ChecksumCache(
+        cache_dir(config) / "checksums.sqlite",
+        max_age=datetime.timedelta(days=config.cache.max_age_days),
+    )
+
+
+def cache_dir(config: Config) -> Path:
+    return config.cache.directory if config.cache else default_cache_dir()
+
+
+def ledger_path(config: Config) -> Path:
+    """Return the ledger of the configured data portal, one file per portal."""
+    return cache_dir(config) / f"ledger-{_portal_name(config)}.sqlite"
+
+
+def spool_path(config: Config) -> Path:
+    """Return the retry spool of the configured data portal, one per portal."""
+    return cache_dir(config) / f"spool-{_portal_name(config)}.sqlite"
+
+
+def _portal_name(config: Config) -> str:
+    url = config.dataportal_config.base_url.split("://", 1)[-1]
+    return re.sub(r"[^\w.-]+", "_", url).strip("_")
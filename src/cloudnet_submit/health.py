@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import datetime
+import random
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class HealthTracker:
+    """Circuit breaker shared by all requests to the data portal.
+
+    After `threshold` consecutive connection errors or 5xx responses the
+    circuit opens, and requests fail immediately instead of each one waiting
+    for its own retries. While open, a single probe request is let through
+    after an exponentially growing, jittered delay. A successful probe closes
+    the circuit again. 429 and 503 responses with a Retry-After header pause
+    all requests for the given time, at most `max_delay`, and the request is
+    repeated at most `max_retries` times.
+    """
+
+    def __init__(
+        self,
+        threshold: int = 5,
+        base_delay: float = 5.0,
+        max_delay: float = 300.0,
+        max_retries: int = 3,
+    ):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.failures = 0
+        self.delay = base_delay
+        self.next_probe: float | None = None
+        self.probing = False
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.next_probe is not None
+
+    def before_request(self) -> None:
+        with self._lock:
+            wait = self.paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        with self._lock:
+            if self.next_probe is None:
+                return
+            remaining = self.next_probe - time.monotonic()
+            if self.probing or remaining > 0:
+                wait = max(remaining, 0)
+                raise CircuitOpen(f"Data portal unavailable, retry in {wait:.0f} s")
+            self.probing = True
+
+    def record(self, res: requests.Response | None) -> float | None:
+        """Record the outcome of a request.
+
+        `res` is None for connection errors. Returns the number of seconds to
+        wait before retrying if the portal asked for it with Retry-After.
+        """
+        retry_after = None
+        if res is not None and res.status_code in (429, 503):
+            retry_after = parse_retry_after(res.headers.get("Retry-After"))
+        with self._lock:
+            self.probing = False
+            if retry_after is not None:
+                wait = min(retry_after, self.max_delay)
+                self.paused_until = max(self.paused_until, time.monotonic() + wait)
+            if res is not None and res.status_code < 500 and res.status_code != 429:
+                self.failures = 0
+                self.delay = self.base_delay
+                self.next_probe = None
+            elif res is None or res.status_code >= 500:
+                self.failures += 1
+                if self.next_probe is not None:
+                    self.delay = min(self.delay * 2, self.max_delay)
+                if self.next_probe is not None or self.failures >= self.threshold:
+                    jitter = random.uniform(0.5, 1.5)
+                    self.next_probe = time.monotonic() + self.delay * jitter
+        return None if retry_after is None else min(retry_after, self.max_delay)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    import email.utils  # noqa: PLC0415
+
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return max(0.0, (date - now).total_seconds())
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import threading
+import time
+from pathlib import Path
+
+from .cache import connect
+
+
+class Ledger:
+    """Files that the data portal has already accepted."""
+
+    def __init__(self, path: Path, lookup: bool = True):
+        self.path = path
+        self.lookup = lookup
+        self._conn = connect(path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS submitted ("
+                "site TEXT NOT NULL, filename TEXT NOT NULL, "
+                "checksum TEXT NOT NULL, submitted REAL NOT NULL, "
+                "PRIMARY KEY (site, filename, checksum))"
+            )
+
+    def contains(self, site: str, filename: str, checksum: str) -> bool:
+        if not self.lookup:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM submitted "
+                "WHERE site = ? AND filename = ? AND checksum = ?",
+                (site, filename, checksum),
+            ).fetchone()
+        return row is not None
+
+    def add(self, site: str, filename: str, checksum: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO submitted VALUES (?, ?, ?, ?)",
+                (site, filename, checksum, time.time()),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
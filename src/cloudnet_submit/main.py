@@ -1,23 +1,153 @@
+from __future__ import annotations
+
+import itertools
+import os
+import signal
 import sys
+import time
+from pathlib import Path
+from typing import Iterator
+
+from .cfg import Config, get_configs
+from .client import Client, cache_dir, with_listing
+from .metrics import Metrics
+from .pipeline import run_pipeline
+from .plan import Plan, estimate_throughput, save_throughput
+from .submission import Submission, SubmissionContext
+from .utils import SeenFiles, Summary, iter_all_submissions
 
-from .cfg import get_config
-from .utils import get_submissions, print_summary
+# Exit status of a run stopped by --deadline with files left for the next run.
+EXIT_DEADLINE = 3
 
 
 def main() -> None:
-    config = get_config()
-    submissions = get_submissions(config)
-    failure = False
-    for sub in sorted(submissions):
-        if not config.dry_run:
-            sub.submit()
-            if not sub.status.ok:
-                failure = True
-        else:
-            sub.dry_run()
-    print_summary(submissions, config.dry_run)
-    if failure:
+    start = time.monotonic()
+    configs = get_configs()
+    # Settings for the whole process come from the first configuration file.
+    config = configs[0]
+    plan = Plan(config.jobs) if config.dry_run else None
+    summary = Summary(config.dry_run, config.shard, plan)
+    if config.dry_run:
+        context = SubmissionContext()
+        try:
+            for sub in _discover(configs, summary, context, SeenFiles()):
+                sub.dry_run()
+                summary.add(sub)
+        except KeyboardInterrupt:
+            pass
+        if plan is not None and plan.n_files > 0:
+            plan.throughput = estimate_throughput(config, throughput_path(config))
+        summary.print()
+        if (report := context.validation.report()) is not None:
+            print(report)
+        return
+    client = Client(configs, verbose=True)
+    context = client.context
+    n_spooled = 0
+    # Paths are only listed by dry runs, so only inodes are remembered.
+    seen = SeenFiles(keep_paths=False)
+    try:
+        uploaded = client.preflight() if config.preflight else None
+        discovered = _discover(configs, summary, context, seen)
+        submissions = _with_retries(client, discovered, seen)
+        submissions = with_listing(submissions, uploaded)
+        deadline = None if config.deadline is None else start + config.deadline
+        run_pipeline(submissions, context, summary, jobs=config.jobs, deadline=deadline)
+    except KeyboardInterrupt:
+        if not config.watch:
+            raise
+    finally:
+        if context.spool is not None:
+            n_spooled = len(context.spool)
+        client.close()
+        # Also on errors and interrupts, so that monitoring sees failed runs.
+        write_metrics(config, client.metrics)
+    metrics = client.metrics
+    save_throughput(throughput_path(config), metrics)
+    summary.print()
+    if n_spooled > 0:
+        noun = "file" if n_spooled == 1 else "files"
+        print(f"{n_spooled} failed {noun} will be retried on later runs.")
+    reports = (
+        client.engine.report(),
+        context.validation.report(),
+    )
+    for report in reports:
+        if report is not None:
+            print(report)
+    if summary.n_fail > 0:
         sys.exit(1)
+    if summary.left:
+        sys.exit(EXIT_DEADLINE)
+
+
+def _discover(
+    configs: list[Config],
+    summary: Summary,
+    context: SubmissionContext,
+    seen: SeenFiles,
+) -> Iterator[Submission]:
+    """Yield the submissions of the given dates, then watched files.
+
+    Each file is yielded at most once, unless it is rewritten while watching.
+    """
+    config = configs[0]
+    submissions: Iterator[Submission] = iter_all_submissions(
+        configs,
+        on_duplicate=summary.add_duplicate,
+        on_record=summary.add_record if config.dry_run else None,
+        on_deferred=summary.add_deferred,
+        context=context,
+        seen=seen,
+    )
+    if config.watch:
+        from .watch import watch_submissions  # noqa: PLC0415
+
+        signal.signal(signal.SIGTERM, _interrupt)
+        submissions = itertools.chain(
+            submissions,
+            watch_submissions(config, settle=config.settle, context=context, seen=seen),
+        )
+    return submissions
+
+
+def _with_retries(
+    client: Client, submissions: Iterator[Submission], seen: SeenFiles
+) -> Iterator[Submission]:
+    """Retry files that failed on earlier runs before discovered files.
+
+    The retried files are claimed in `seen`, so discovery skips them.
+    """
+    retries = []
+    for sub in client.spooled_submissions():
+        try:
+            st = os.stat(sub.path)
+        except OSError:
+            continue
+        if seen.claim(str(sub.path), st) is None:
+            retries.append(sub)
+    if not retries:
+        return submissions
+    noun = "file" if len(retries) == 1 else "files"
+    print(f"Retrying {len(retries)} {noun} that failed on earlier runs.")
+    return itertools.chain(retries, submissions)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def write_metrics(config: Config, metrics: Metrics) -> None:
+    if config.metrics.json is not None:
+        metrics.write_json(config.metrics.json)
+    if config.metrics.textfile is not None:
+        metrics.write_textfile(config.metrics.textfile)
+
+
+def throughput_path(config: Config) -> Path | None:
+    if config.cache is None or not config.cache.enabled:
+        return None
+    return cache_dir(config) / "throughput.json"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+PHASES = ("scan", "hash", "metadata", "data")
+
+
+@dataclass
+class PhaseStats:
+    count: int = 0
+    seconds: float = 0.0
+    bytes: int = 0
+
+    @property
+    def throughput(self) -> float | None:
+        if self.bytes == 0 or self.seconds <= 0:
+            return None
+        return self.bytes / self.seconds
+
+
+class Metrics:
+    """Timings and counters collected during a run, safe to update from threads.
+
+    Timings are kept per phase and site. Time spent in parallel threads is
+    summed, so phase times can exceed the duration of the run.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.time()
+        self.end: float | None = None
+        self.phases: dict[tuple[str, str], PhaseStats] = {}
+        self.responses: Counter[tuple[str, int]] = Counter()
+        self.retries: Counter[str] = Counter()
+        self.files: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float, n_bytes: int = 0, site: str = "") -> None:
+        with self._lock:
+            stats = self.phases.setdefault((phase, site), PhaseStats())
+            stats.count += 1
+            stats.seconds += seconds
+            stats.bytes += n_bytes
+
+    def response(self, phase: str, status: int, retries: int = 0) -> None:
+        with self._lock:
+            self.responses[(phase, status)] += 1
+            self.retries[phase] += retries
+
+    def file(self, result: str) -> None:
+        with self._lock:
+            self.files[result] += 1
+
+    def finish(self) -> None:
+        self.end = time.time()
+
+    def totals(self) -> dict[str, PhaseStats]:
+        totals = {phase: PhaseStats() for phase in PHASES}
+        with self._lock:
+            for (phase, _), stats in self.phases.items():
+                total = totals.setdefault(phase, PhaseStats())
+                total.count += stats.count
+                total.seconds += stats.seconds
+                total.bytes += stats.bytes
+        return totals
+
+    def as_dict(self) -> dict:
+        end = self.end if self.end is not None else time.time()
+        with self._lock:
+            sites: dict[str, dict] = {}
+            for (phase, site), stats in sorted(self.phases.items()):
+                if site:
+                    sites.setdefault(site, {})[phase] = _phase_dict(stats)
+            responses: dict[str, dict[str, int]] = {}
+            for (phase, status), count in sorted(self.responses.items()):
+                responses.setdefault(phase, {})[str(status)] = count
+            retries = dict(self.retries)
+            files = dict(self.files)
+        return {
+            "start": self.start,
+            "duration": end - self.start,
+            "files": files,
+            "phases": {k: _phase_dict(v) for k, v in self.totals().items()},
+            "sites": sites,
+            "responses": responses,
+            "retries": retries,
+        }
+
+    def write_json(self, path: Path) -> None:
+        _write_atomic(path, json.dumps(self.as_dict(), indent=2) + "\n")
+
+    def write_textfile(self, path: Path) -> None:
+        """Write metrics in the format of the Prometheus textfile collector."""
+        report = self.as_dict()
+        lines = [
+            "# HELP cloudnet_submit_last_run_timestamp_seconds Start of the run.",
+            "# TYPE cloudnet_submit_last_run_timestamp_seconds gauge",
+            f"cloudnet_submit_last_run_timestamp_seconds {report['start']:.3f}",
+            "# HELP cloudnet_submit_run_duration_seconds Duration of the run.",
+            "# TYPE cloudnet_submit_run_duration_seconds gauge",
+            f"cloudnet_submit_run_duration_seconds {report['duration']:.3f}",
+            "# HELP cloudnet_submit_files Files processed by result.",
+            "# TYPE cloudnet_submit_files gauge",
+        ]
+        for result, count in sorted(report["files"].items()):
+            lines.append(f'cloudnet_submit_files{{result="{result}"}} {count}')
+        with self._lock:
+            phases = sorted(self.phases.items())
+        for name, field, help_text in (
+            ("phase_seconds", "seconds", "Time spent in each phase."),
+            ("phase_operations", "count", "Operations in each phase."),
+            ("phase_bytes", "bytes", "Bytes processed in each phase."),
+        ):
+            lines.append(f"# HELP cloudnet_submit_{name} {help_text}")
+            lines.append(f"# TYPE cloudnet_submit_{name} gauge")
+            for (phase, site), stats in phases:
+                labels = _labels(phase=phase, site=site)
+                lines.append(
+                    f"cloudnet_submit_{name}{labels} {getattr(stats, field):g}"
+                )
+        lines += [
+            "# HELP cloudnet_submit_http_responses HTTP responses by status.",
+            "# TYPE cloudnet_submit_http_responses gauge",
+        ]
+        for phase, statuses in report["responses"].items():
+            for status, count in statuses.items():
+                labels = _labels(phase=phase, status=status)
+                lines.append(f"cloudnet_submit_http_responses{labels} {count}")
+        lines += [
+            "# HELP cloudnet_submit_http_retries Retried HTTP requests.",
+            "# TYPE cloudnet_submit_http_retries gauge",
+        ]
+        for phase, count in sorted(report["retries"].items()):
+            lines.append(f"cloudnet_submit_http_retries{_labels(phase=phase)} {count}")
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _phase_dict(stats: PhaseStats) -> dict:
+    return {**asdict(stats), "throughput": stats.throughput}
+
+
+def _labels(**labels: str) -> str:
+    values = ",".join(
+        f'{key}="{_escape(value)}"' for key, value in labels.items() if value
+    )
+    return f"{{{values}}}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(path: Path, content: str) -> None:
+    # The textfile collector may read the file at any time, so never expose a
+    # partially written file.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
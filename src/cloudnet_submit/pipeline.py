@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from typing import Iterable
+
+from .submission import Submission, SubmissionContext
+from .utils import Summary
+
+_DONE = None
+
+
+def run_pipeline(
+    submissions: Iterable[Submission],
+    context: SubmissionContext,
+    summary: Summary,
+    jobs: int = 1,
+    queue_size: int | None = None,
+    deadline: float | None = None,
+) -> None:
+    """Hash and submit files while they are still being discovered.
+
+    Discovery runs in the calling thread and feeds a bounded queue. Hashing of
+    a file starts when it enters the queue, using the checksum engine of
+    `context`, and `jobs` worker threads submit files from the queue in order.
+
+    After `deadline`, a `time.monotonic()` value, no new submissions are
+    started. Submissions in progress are finished, and the files that were
+    already discovered are added to the summary as left over.
+    """
+    if queue_size is None:
+        queue_size = max(16, 4 * jobs)
+    pending: queue.Queue[Submission | None] = queue.Queue(maxsize=queue_size)
+    errors: list[BaseException] = []
+    progress = jobs == 1
+    engine = context.checksum_engine
+
+    def expired() -> bool:
+        return deadline is not None and time.monotonic() >= deadline
+
+    def forget(sub: Submission) -> None:
+        if engine is not None:
+            engine.forget(sub.path)
+
+    def leave(sub: Submission) -> None:
+        forget(sub)
+        summary.add_left(sub)
+        if context.metrics is not None:
+            context.metrics.file("left")
+
+    def worker() -> None:
+        while True:
+            sub = pending.get()
+            if sub is _DONE:
+                return
+            if errors:
+                forget(sub)
+                continue
+            if expired():
+                leave(sub)
+                continue
+            try:
+                sub.submit(progress=progress)
+            except BaseException as err:
+                errors.append(err)
+                continue
+            summary.add(sub)
+
+    workers = [
+        threading.Thread(target=worker, name=f"submit-{i}", daemon=True)
+        for i in range(jobs)
+    ]
+    for thread in workers:
+        thread.start()
+    try:
+        for sub in submissions:
+            if errors:
+                break
+            if expired():
+                leave(sub)
+                summary.stopped = True
+                break
+            if engine is not None and engine.single_read_threshold is None:
+                engine.prefetch([sub.path], site=sub.metadata.site)
+            pending.put(sub)
+    finally:
+        for _ in workers:
+            pending.put(_DONE)
+        for thread in workers:
+            thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,154 @@
+"""Estimate the size and duration of a submission during a dry run."""
+
+from __future__ import annotations
+
+import heapq
+import json
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .cfg import Config
+
+if TYPE_CHECKING:
+    from .metrics import Metrics
+    from .submission import Submission
+
+N_LARGEST = 5
+
+
+@dataclass
+class Throughput:
+    rate: float
+    latency: float = 0.0
+    source: str = "configured"
+
+    def duration(self, n_files: int, n_bytes: int, jobs: int = 1) -> float:
+        """Project the time to submit files, each needing two requests."""
+        return n_bytes / self.rate + 2 * n_files * self.latency / jobs
+
+
+class Plan:
+    """Files and bytes a dry run would submit, from file sizes only.
+
+    Updated by `Summary`, which holds its lock while adding submissions.
+    """
+
+    def __init__(self, jobs: int = 1):
+        self.jobs = jobs
+        self.n_files = 0
+        self.n_bytes = 0
+        self.targets: dict[tuple[str, str], list[int]] = {}
+        self.largest: list[tuple[int, str]] = []
+        self.throughput: Throughput | None = None
+
+    def add(self, sub: Submission) -> None:
+        size = sub.size
+        if size is None:
+            size = sub.path.stat().st_size
+        key = (sub.metadata.site, sub.get_model_or_instrument())
+        self.n_files += 1
+        self.n_bytes += size
+        counts = self.targets.setdefault(key, [0, 0])
+        counts[0] += 1
+        counts[1] += size
+        item = (size, str(sub.path))
+        if len(self.largest) < N_LARGEST:
+            heapq.heappush(self.largest, item)
+        else:
+            heapq.heappushpop(self.largest, item)
+
+    def print(self) -> None:
+        if self.n_files == 0:
+            return
+        print(f"\n{'Site':<16} {'Instrument/model':<22} {'Files':>8} {'Size':>10}")
+        for (site, target), (n_files, n_bytes) in sorted(self.targets.items()):
+            print(f"{site:<16} {target:<22} {n_files:>8} {format_bytes(n_bytes):>10}")
+        print(f"{'Total':<39} {self.n_files:>8} {format_bytes(self.n_bytes):>10}")
+        print("\nLargest files:")
+        for size, path in sorted(self.largest, reverse=True):
+            print(f"  {format_bytes(size):>10}  {path}")
+        print("")
+        if self.throughput is None:
+            print(
+                "Use --limit-rate or a previous run to project the duration "
+                "of the submission."
+            )
+            return
+        seconds = self.throughput.duration(self.n_files, self.n_bytes, self.jobs)
+        print(
+            f"Projected duration {format_duration(seconds)} at "
+            f"{format_bytes(self.throughput.rate)}/s and "
+            f"{self.throughput.latency:.2f} s per request "
+            f"({self.throughput.source})."
+        )
+
+
+def estimate_throughput(config: Config, path: Path | None) -> Throughput | None:
+    """Return the expected throughput of uploads.
+
+    The throughput is measured by the uploads of the last run, saved in `path`
+    unless the cache is disabled. Without it, the bandwidth limit is used.
+    Parallel uploads are assumed to share the measured rate, and a bandwidth
+    limit caps it.
+    """
+    throughput = load_throughput(path)
+    limit = config.bandwidth.limit
+    if limit is not None:
+        if throughput is None:
+            return Throughput(limit)
+        throughput.rate = min(throughput.rate, limit)
+    return throughput
+
+
+def load_throughput(path: Path | None) -> Throughput | None:
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            return Throughput(**json.load(f))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def save_throughput(path: Path | None, metrics: Metrics) -> None:
+    """Remember the upload rate and request time measured during a run."""
+    if path is None:
+        return
+    totals = metrics.totals()
+    data, meta = totals["data"], totals["metadata"]
+    if data.throughput is None or meta.count == 0:
+        return
+    throughput = Throughput(
+        rate=data.throughput,
+        latency=meta.seconds / meta.count,
+        source=f"run of {time.strftime('%Y-%m-%d %H:%M')}",
+    )
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(asdict(throughput), f)
+    except OSError:
+        pass
+
+
+def format_bytes(n_bytes: float) -> str:
+    for unit in ("B", "kB", "MB", "GB"):
+        if abs(n_bytes) < 1000:
+            return f"{n_bytes:.0f} {unit}" if unit == "B" else f"{n_bytes:.1f} {unit}"
+        n_bytes /= 1000
+    return f"{n_bytes:.1f} TB"
+
+
+def format_duration(seconds: float) -> str:
+    minutes, secs = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f"{days} d {hours} h"
+    if hours:
+        return f"{hours} h {minutes} min"
+    if minutes:
+        return f"{minutes} min {secs} s"
+    return f"{secs} s"
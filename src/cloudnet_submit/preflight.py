@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import datetime
+
+import requests
+
+from .cfg import Config
+
+
+def fetch_uploaded_checksums(
+    config: Config, session: requests.Session
+) -> set[tuple[str, str]] | None:
+    """List (site, checksum) pairs of files already uploaded to the portal.
+
+    One request is made per site and instrument or model over the whole date
+    range. Returns None if any of the listings is unavailable, in which case
+    every file should be checked separately.
+    """
+    if not config.dates:
+        return set()
+    date_from = min(config.dates).replace(day=1)
+    date_to = max(config.dates)
+    queries: dict[tuple[str, ...], tuple[str, dict[str, str]]] = {}
+    for iconf in config.instrument:
+        key = ("instrument", iconf.site, iconf.instrument)
+        params = {"site": iconf.site, "instrument": iconf.instrument}
+        queries[key] = (config.dataportal_config.instrument.files_url, params)
+    for mconf in config.model:
+        key = ("model", mconf.site, mconf.model)
+        params = {"site": mconf.site, "model": mconf.model}
+        queries[key] = (config.dataportal_config.model.files_url, params)
+    uploaded: set[tuple[str, str]] = set()
+    for url, params in queries.values():
+        files = _list_files(config, session, url, params, date_from, date_to)
+        if files is None:
+            return None
+        for file in files:
+            if file.get("status") != "created" and "checksum" in file:
+                uploaded.add((params["site"], file["checksum"]))
+    return uploaded
+
+
+def _list_files(
+    config: Config,
+    session: requests.Session,
+    url: str,
+    params: dict[str, str],
+    date_from: datetime.date,
+    date_to: datetime.date,
+) -> list[dict] | None:
+    params = {
+        **params,
+        "dateFrom": date_from.isoformat(),
+        "dateTo": date_to.isoformat(),
+    }
+    try:
+        res = session.get(
+            url,
+            params=params,
+            headers=config.dataportal_config.headers,
+            timeout=config.timeouts.requests,
+        )
+    except requests.RequestException:
+        return None
+    if not res.ok:
+        return None
+    try:
+        files = res.json()
+    except ValueError:
+        return None
+    if not isinstance(files, list):
+        return None
+    return [file for file in files if isinstance(file, dict)]
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .cache import connect
+
+if TYPE_CHECKING:
+    from .submission import Status, Submission
+
+# Client errors that may go away without changing the file or its metadata.
+RETRYABLE_CLIENT_ERRORS = {401, 403, 408, 429}
+
+
+@dataclass
+class SpoolEntry:
+    path: str
+    site: str
+    measurement_date: str
+    checksum: str | None
+    status: str
+    attempts: int
+    next_attempt: float
+
+
+class RetrySpool:
+    """Files that could not be submitted, retried on later runs.
+
+    After each failure, the next retry is postponed twice as long as the
+    previous one, from `min_backoff` up to `max_backoff` seconds. A file is
+    forgotten after `max_attempts` failures, or when the data portal rejects
+    it with a client error that a retry cannot fix, like invalid metadata.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        min_backoff: float = 600.0,
+        max_backoff: float = 86400.0,
+        max_attempts: int = 10,
+    ):
+        self.path = path
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._conn = connect(path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS spool ("
+                "path TEXT PRIMARY KEY, site TEXT NOT NULL, "
+                "measurement_date TEXT NOT NULL, checksum TEXT, "
+                "status TEXT NOT NULL, attempts INTEGER NOT NULL, "
+                "next_attempt REAL NOT NULL)"
+            )
+
+    def update(self, sub: Submission, error: str | None = None) -> None:
+        """Spool a failed submission, or forget it once it has succeeded.
+
+        `error` describes an exception that interrupted the submission.
+        """
+        if sub.status.deferred:
+            return
+        path = os.path.abspath(sub.path)
+        if sub.status.ok or _is_permanent(sub.status):
+            self.remove(path)
+            return
+        status = " | ".join(
+            str(msg)
+            for msg in (sub.status.metadata_msg, sub.status.data_msg, error)
+            if msg is not None
+        )
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT attempts FROM spool WHERE path = ?", (path,)
+            ).fetchone()
+            attempts = 1 if row is None else row[0] + 1
+            if attempts >= self.max_attempts:
+                self._conn.execute("DELETE FROM spool WHERE path = ?", (path,))
+                return
+            delay = min(self.min_backoff * 2 ** (attempts - 1), self.max_backoff)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO spool VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    sub.metadata.site,
+                    sub.metadata.measurement_date.isoformat(),
+                    sub.metadata.checksum,
+                    status[:1000],
+                    attempts,
+                    time.time() + delay,
+                ),
+            )
+
+    def due(self) -> list[SpoolEntry]:
+        """Return the entries whose next retry is due, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM spool WHERE next_attempt <= ? "
+                "ORDER BY measurement_date, path",
+                (time.time(),),
+            ).fetchall()
+        return [SpoolEntry(*row) for row in rows]
+
+    def remove(self, path: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM spool WHERE path = ?", (path,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) FROM spool").fetchone()
+        return int(row[0])
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _is_permanent(status: Status) -> bool:
+    return any(
+        code is not None and 400 <= code < 500 and code not in RETRYABLE_CLIENT_ERRORS
+        for code in (status.metadata, status.data)
+    )
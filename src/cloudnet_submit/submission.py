@@ -1,16 +1,32 @@
 from __future__ import annotations
 
 import datetime
-import hashlib
+import io
+import threading
+import time
 from dataclasses import dataclass
 from pathlib import Path
 from sys import stdout
+from typing import IO, TYPE_CHECKING, Callable
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from .cfg import DataportalConfig, ProxyConfig, TimeoutConfig
+from .checksum import compute_checksum
+from .health import CircuitOpen
+from .throttle import Stream, ThrottledReader, TransferStalled, WatchedReader
+from .validation import ValidationStats
 
-from .cfg import DataportalConfig, ProxyConfig
+# HTTP libraries are imported when the first session is created, so that dry
+# runs start quickly.
+if TYPE_CHECKING:
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    from .checksum import ChecksumEngine
+    from .health import HealthTracker
+    from .ledger import Ledger
+    from .metrics import Metrics
+    from .spool import RetrySpool
+    from .throttle import TokenBucket
 
 
 @dataclass
@@ -42,11 +58,83 @@ class Status:
     data: int | None = None
     metadata_msg: str | None = None
     data_msg: str | None = None
+    problem: str | None = None
+    deferred: bool = False
 
 
-class Submission:
-    session = None
+_print_lock = threading.Lock()
+
+
+class SessionPool:
+    """Thread-local sessions sharing one bounded connection pool."""
+
+    def __init__(self, proxy_config: ProxyConfig, size: int = 1):
+        self.proxy_config = proxy_config
+        self.adapter = make_adapter(size)
+        self._local = threading.local()
+
+    def get(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = make_session(self.proxy_config, self.adapter)
+            self._local.session = session
+        return session
+
+    def close(self) -> None:
+        self.adapter.close()
+
+
+class SubmissionContext:
+    """State shared by the submissions of one client or command-line run.
+
+    Holds the connections, the checksum engine, the ledger, the retry spool,
+    the health of the data portal, the bandwidth limit and the metrics. Status
+    lines of submitted files are printed only if `verbose` is set.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 1,
+        timeouts: TimeoutConfig | None = None,
+        verbose: bool = True,
+    ):
+        self.pool_size = pool_size
+        self.timeouts = timeouts if timeouts is not None else TimeoutConfig()
+        self.verbose = verbose
+        self.session_pools: dict[tuple[str | None, str | None], SessionPool] = {}
+        self.checksum_engine: ChecksumEngine | None = None
+        self.ledger: Ledger | None = None
+        self.spool: RetrySpool | None = None
+        self.validation = ValidationStats()
+        self.bandwidth: TokenBucket | None = None
+        self.health: HealthTracker | None = None
+        self.metrics: Metrics | None = None
+        self._pool_lock = threading.Lock()
+
+    def session_pool(self, proxy_config: ProxyConfig) -> SessionPool:
+        """Return the session pool shared by submissions using the same proxies."""
+        key = (proxy_config.http, proxy_config.https)
+        with self._pool_lock:
+            pool = self.session_pools.get(key)
+            if pool is None:
+                pool = SessionPool(proxy_config, self.pool_size)
+                self.session_pools[key] = pool
+        return pool
+
+    def close(self) -> None:
+        if self.checksum_engine is not None:
+            self.checksum_engine.close()
+        if self.ledger is not None:
+            self.ledger.close()
+        if self.spool is not None:
+            self.spool.close()
+        with self._pool_lock:
+            for pool in self.session_pools.values():
+                pool.close()
+            self.session_pools.clear()
+
 
+class Submission:
     def __init__(
         self,
         path: Path,
@@ -54,14 +142,25 @@ class Submission:
         auth: tuple[str, str],
         dataportal_config: DataportalConfig,
         proxy_config: ProxyConfig,
+        validate: str | None = None,
+        context: SubmissionContext | None = None,
     ):
+        self.context = context if context is not None else SubmissionContext()
         self.path = path
+        self.size: int | None = None
+        self.validate = validate
         self.metadata = metadata
         self.auth = auth
         self.status = Status()
-        if Submission.session is None:
-            Submission.session = make_session(proxy_config)
+        self.payload: IO[bytes] | None = None
+        self.proxy_config = proxy_config
         self.dataportal_config = dataportal_config
+        # Files listed on the data portal before the submission, if known.
+        self.uploaded_checksums: set[tuple[str, str]] | None = None
+
+    @property
+    def session(self) -> requests.Session:
+        return self.context.session_pool(self.proxy_config).get()
 
     def __gt__(self, other):
         return (self.metadata.measurement_date, self.metadata.site) > (
@@ -91,13 +190,33 @@ class Submission:
 
     def compute_checksum(self):
         if self.metadata.checksum is None:
-            self.metadata.checksum = compute_checksum(self.path)
+            engine = self.context.checksum_engine
+            if engine is None:
+                self.metadata.checksum = compute_checksum(self.path)
+            elif engine.single_read_threshold is not None:
+                self.metadata.checksum, self.payload = engine.read_once(
+                    self.path, site=self.metadata.site
+                )
+            else:
+                self.metadata.checksum = engine.checksum(
+                    self.path, site=self.metadata.site
+                )
         if self.metadata.checksum is None:
             raise ValueError(f"Checksum for {self.path} is None")
 
+    def check_format(self) -> bool:
+        """Check the file headers, returning False if the file is deferred."""
+        if self.validate is None:
+            return True
+        start = time.perf_counter()
+        self.status.problem = self.context.validation.check(self.path)
+        self._measure("validate", start)
+        if self.status.problem is None or self.validate == "warn":
+            return True
+        self.status.deferred = True
+        return False
+
     def submit_metadata(self):
-        if self.session is None:
-            raise TypeError
         self.compute_checksum()
         body: dict[str, None | str | list[str]] = {
             "site": self.metadata.site,
@@ -115,18 +234,23 @@ class Submission:
             body["model"] = self.metadata.model
             url = self.dataportal_config.model.metadata_url
 
-        res = self.session.post(
-            url, json=body, auth=self.auth, headers=self.dataportal_config.headers
+        start = time.perf_counter()
+        res = self._request(
+            "post",
+            url,
+            json=body,
+            auth=self.auth,
+            headers=self.dataportal_config.headers,
         )
+        self._measure("metadata", start)
         self.status.metadata = res.status_code
         self.status.metadata_msg = res.text
         if res.ok:
             self.status.metadata_ok = True
 
     def submit_data(self):
-        if self.session is None:
-            raise TypeError
-        with self.path.open("rb") as data:
+        data = self.payload if self.payload is not None else self.path.open("rb")
+        with data:
             if isinstance(self.metadata.checksum, str):
                 checksum = self.metadata.checksum
                 url = (
@@ -134,12 +258,17 @@ class Submission:
                     if isinstance(self.metadata, InstrumentMetadata)
                     else self.dataportal_config.model.data_url(checksum)
                 )
-                res = self.session.put(
+                size = data.seek(0, io.SEEK_END)
+                data.seek(0)
+                start = time.perf_counter()
+                res = self._request(
+                    "put",
                     url,
-                    data=data,
+                    data=self._body(data),
                     auth=self.auth,
                     headers=self.dataportal_config.headers,
                 )
+                self._measure("data", start, size)
             else:
                 raise ValueError(f"{self}, missing checksum")
         self.status.data = res.status_code
@@ -147,47 +276,212 @@ class Submission:
         if res.ok:
             self.status.data_ok = True
 
+    def _measure(self, phase: str, start: float, n_bytes: int = 0) -> None:
+        if self.context.metrics is not None:
+            elapsed = time.perf_counter() - start
+            self.context.metrics.add(phase, elapsed, n_bytes, site=self.metadata.site)
+
+    def _record_response(
+        self, phase: str, res: requests.Response, retries: int = 0
+    ) -> None:
+        if self.context.metrics is None:
+            return
+        # Retries made by urllib3 are only visible in the response.
+        raw = getattr(res, "raw", None)
+        history = getattr(getattr(raw, "retries", None), "history", None) or ()
+        self.context.metrics.response(phase, res.status_code, retries + len(history))
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        import requests  # noqa: PLC0415
+
+        send: Callable[..., requests.Response] = getattr(self.session, method)
+        phase = "metadata" if method == "post" else "data"
+        health = self.context.health
+        timeouts = self.context.timeouts
+        kwargs.setdefault("timeout", timeouts.requests)
+        attempt = 0
+        stalls = 0
+        # Retries already counted with an earlier response of this request.
+        counted = 0
+        while True:
+            if health is not None:
+                health.before_request()
+            try:
+                res = send(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout, TransferStalled) as err:
+                if health is not None:
+                    health.record(None)
+                if not isinstance(err, TransferStalled):
+                    raise
+                if stalls == timeouts.stall_retries:
+                    raise
+                # The stalled connection is dropped, so the upload starts
+                # again on a new one.
+                stalls += 1
+                kwargs["data"].seek(0)
+                continue
+            self._record_response(phase, res, retries=attempt + stalls - counted)
+            counted = attempt + stalls
+            if health is None:
+                return res
+            retry_after = health.record(res)
+            if retry_after is None or attempt == health.max_retries:
+                return res
+            attempt += 1
+            if (data := kwargs.get("data")) is not None:
+                data.seek(0)
+
+    def _body(self, data: Stream) -> Stream:
+        """Wrap an upload body in the bandwidth limit and the stall watchdog."""
+        timeouts = self.context.timeouts
+        if self.context.bandwidth is not None:
+            data = ThrottledReader(data, self.context.bandwidth)
+        if timeouts.min_rate is not None:
+            data = WatchedReader(data, timeouts.min_rate, timeouts.stall_time)
+        return data
+
     def print_status(self, end):
+        if not self.context.verbose:
+            return
         meta = (
             str(self.status.metadata_msg)
             if self.status.metadata_msg is not None
             else "-"
         )
         data = str(self.status.data_msg) if self.status.data_msg is not None else "-"
-        stdout.write(f"[meta: {meta} | data: {data}] {self}{end}")
-
-    def submit(self):
-        self.print_status("\r")
-        self.submit_metadata()
-        self.print_status("\r")
-        if self.status.metadata_ok:
-            self.submit_data()
+        with _print_lock:
+            stdout.write(f"[meta: {meta} | data: {data}] {self}{end}")
+
+    def submit(self, progress: bool = True):
+        try:
+            self._submit(progress)
+        except Exception as err:
+            if self.context.spool is not None:
+                self.context.spool.update(self, error=str(err) or type(err).__name__)
+            raise
+        else:
+            if self.context.spool is not None:
+                self.context.spool.update(self)
+        finally:
+            if self.payload is not None:
+                self.payload.close()
+                self.payload = None
+
+    def _submit(self, progress: bool):
+        import requests  # noqa: PLC0415
+
+        if not self.check_format():
+            self.status.metadata_msg = f"Deferred: {self.status.problem}"
+            if self.context.checksum_engine is not None:
+                self.context.checksum_engine.forget(self.path)
+            if self.context.metrics is not None:
+                self.context.metrics.file("deferred")
+            self.print_status("\n")
+            return
+        if self.context.ledger is not None and self.context.ledger.lookup:
+            self.compute_checksum()
+            if self._in_ledger():
+                self.skip("Already submitted")
+                return
+        if self.uploaded_checksums is not None:
+            self.compute_checksum()
+            key = (self.metadata.site, str(self.metadata.checksum))
+            if key in self.uploaded_checksums:
+                self.skip("Already submitted")
+                if self.context.ledger is not None:
+                    self.context.ledger.add(
+                        self.metadata.site, self.metadata.filename, key[1]
+                    )
+                return
+        try:
+            if progress:
+                self.print_status("\r")
+            self.submit_metadata()
+            if progress:
+                self.print_status("\r")
+            if self.status.metadata_ok:
+                self.submit_data()
+        except (
+            CircuitOpen,
+            TransferStalled,
+            requests.ConnectionError,
+            requests.Timeout,
+        ) as err:
+            if isinstance(err, (CircuitOpen, TransferStalled)):
+                msg = str(err)
+            elif isinstance(err, requests.Timeout):
+                msg = "Timed out"
+            else:
+                msg = "Connection failed"
+            if self.status.metadata_ok:
+                self.status.data_msg = msg
+            else:
+                self.status.metadata_msg = msg
         self.print_status("\n")
         self.status.ok = (
             self.status.metadata == 200 and self.status.data_ok
         ) or self.status.metadata == 409
+        if self.context.metrics is not None:
+            self.context.metrics.file("submitted" if self.status.ok else "failed")
+        if self.status.ok and self.context.ledger is not None:
+            self.context.ledger.add(
+                self.metadata.site, self.metadata.filename, str(self.metadata.checksum)
+            )
+
+    def skip(self, reason: str):
+        self.status.ok = True
+        self.status.metadata_msg = reason
+        if self.context.metrics is not None:
+            self.context.metrics.file("skipped")
+        self.print_status("\n")
+
+    def _in_ledger(self) -> bool:
+        return self.context.ledger is not None and self.context.ledger.contains(
+            self.metadata.site, self.metadata.filename, str(self.metadata.checksum)
+        )
 
     def dry_run(self):
         info_str = self.__str_dry__()
-        stdout.write(f"{info_str}\n")
+        self.check_format()
+        if self.status.problem is not None:
+            info_str += f" [{self.status.problem}]"
+        with _print_lock:
+            stdout.write(f"{info_str}\n")
+
 
+def make_adapter(pool_size: int = 1) -> HTTPAdapter:
+    from requests.adapters import HTTPAdapter  # noqa: PLC0415
+    from urllib3.util.retry import Retry  # noqa: PLC0415
 
-def make_session(proxy_config: ProxyConfig) -> requests.Session:
-    retries = Retry(total=10, backoff_factor=0.2)
-    adapter = HTTPAdapter(max_retries=retries)
+    # Read errors are raised without retrying, so that read_timeout bounds a
+    # request and a timeout is reported as such. Responses are returned as
+    # they are, because HealthTracker handles Retry-After with a cap.
+    retries = Retry(
+        total=10,
+        connect=3,
+        read=False,
+        status=0,
+        respect_retry_after_header=False,
+        raise_on_status=False,
+        backoff_factor=0.2,
+    )
+    return HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retries,
+        pool_block=True,
+    )
+
+
+def make_session(
+    proxy_config: ProxyConfig, adapter: HTTPAdapter | None = None
+) -> requests.Session:
+    import requests  # noqa: PLC0415
+
+    if adapter is None:
+        adapter = make_adapter()
     session = requests.Session()
     session.proxies.update(proxy_config.asdict())
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
-
-
-def compute_checksum(path: Path):
-    block_size = 512
-    md5hash = hashlib.md5()
-    with path.open("rb") as f:
-        chunk = f.read(block_size)
-        while chunk:
-            md5hash.update(chunk)
-            chunk = f.read(block_size)
-    return md5hash.hexdigest()
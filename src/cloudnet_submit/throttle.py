@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import datetime
+import io
+import threading
+import time
+from typing import Callable, Iterator, Protocol
+
+from .cfg import BandwidthConfig
+
+BLOCK_SIZE = 64 * 1024
+
+
+class Stream(Protocol):
+    def read(self, __size: int = -1) -> bytes: ...
+
+    def tell(self) -> int: ...
+
+    def seek(self, __offset: int, __whence: int = io.SEEK_SET) -> int: ...
+
+
+class TokenBucket:
+    """Global upload rate limit shared by all upload threads.
+
+    Each read takes tokens from the bucket. When the bucket runs out, the
+    reader sleeps until enough tokens have been refilled, so concurrent
+    uploads share the configured bandwidth between them.
+    """
+
+    def __init__(self, rate: Callable[[], float | None], burst: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: BandwidthConfig) -> TokenBucket | None:
+        if config.limit is None and not config.profiles:
+            return None
+        return cls(lambda: config.current_limit(datetime.datetime.now().time()))
+
+    def consume(self, n: int) -> None:
+        with self._lock:
+            rate = self.rate()
+            now = time.monotonic()
+            if rate is None:
+                self._tokens = 0.0
+                self._updated = now
+                return
+            elapsed = now - self._updated
+            self._tokens = min(self._tokens + elapsed * rate, self.burst * rate)
+            self._tokens -= n
+            self._updated = now
+            wait = -self._tokens / rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledReader:
+    """File-like wrapper that limits how fast an upload body can be read."""
+
+    def __init__(self, source: Stream, bucket: TokenBucket):
+        self.source = source
+        self.bucket = bucket
+        try:
+            position = source.tell()
+            self.len = source.seek(0, io.SEEK_END)
+            source.seek(position)
+        except OSError:
+            # Unknown length: requests sends the body in chunks.
+            pass
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        remaining = size
+        while remaining != 0:
+            n = BLOCK_SIZE if remaining < 0 else min(remaining, BLOCK_SIZE)
+            data = self.source.read(n)
+            if not data:
+                break
+            self.bucket.consume(len(data))
+            chunks.append(data)
+            if remaining > 0:
+                remaining -= len(data)
+        return b"".join(chunks)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while chunk := self.read(BLOCK_SIZE):
+            yield chunk
+
+    def tell(self) -> int:
+        return self.source.tell()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self.source.seek(offset, whence)
+
+
+class TransferStalled(Exception):
+    pass
+
+
+class WatchedReader:
+    """File-like wrapper that aborts an upload that has stalled.
+
+    Only the time spent outside `read`, i.e. sending the data, is measured,
+    so a bandwidth limit or a slow file system does not count as a stall.
+    TransferStalled is raised from `read` when less than `min_rate` bytes per
+    second have been sent during the last `stall_time` seconds.
+    """
+
+    def __init__(self, source: Stream, min_rate: float, stall_time: float):
+        self.source = source
+        self.min_rate = min_rate
+        self.stall_time = stall_time
+        self._reset()
+        try:
+            position = source.tell()
+            self.len = source.seek(0, io.SEEK_END)
+            source.seek(position)
+        except OSError:
+            pass
+
+    def _reset(self) -> None:
+        self._sending = 0.0
+        self._sent = 0
+        self._returned: float | None = None
+
+    def read(self, size: int = -1) -> bytes:
+        if self._returned is not None:
+            self._sending += time.monotonic() - self._returned
+            if self._sending >= self.stall_time:
+                if self._sent < self.min_rate * self._sending:
+                    rate = self._sent / self._sending / 1000
+                    raise TransferStalled(
+                        f"Transfer stalled at {rate:.1f} kB/s for {self._sending:.0f} s"
+                    )
+                self._sending = 0.0
+                self._sent = 0
+        data = self.source.read(size)
+        self._sent += len(data)
+        self._returned = time.monotonic()
+        return data
+
+    def __iter__(self) -> Iterator[bytes]:
+        while chunk := self.read(BLOCK_SIZE):
+            yield chunk
+
+    def tell(self) -> int:
+        return self.source.tell()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._reset()
+        return self.source.seek(offset, whence)
@@ -1,119 +1,536 @@
 import datetime
 import glob
-import itertools
+import hashlib
+import heapq
+import os
+import stat
+import threading
+import time
 from pathlib import Path
-from typing import List
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
-from braceexpand import braceexpand
-
-from .cfg import Config
-from .submission import InstrumentMetadata, ModelMetadata, Submission
+from .cfg import Config, InstrumentConfig, ModelConfig, StabilityConfig
+from .metrics import Metrics
+from .plan import Plan
+from .submission import (
+    InstrumentMetadata,
+    ModelMetadata,
+    Submission,
+    SubmissionContext,
+)
 
 
 def get_files(date: datetime.date, path_fmt: str) -> List[Path]:
-    files: List[Path] = []
-    for pattern in braceexpand(date.strftime(path_fmt)):
-        for path_str in glob.glob(pattern):
-            path = Path(path_str)
-            if path.is_file():
-                files.append(path)
-    return files
+    return [Path(path) for path, _ in iter_files(date, path_fmt)]
+
+
+def iter_files(
+    date: datetime.date, path_fmt: str
+) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield the path and stat result of each regular file matching `path_fmt`."""
+    for pattern in expand_braces(date.strftime(path_fmt)):
+        for path in glob.glob(pattern):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                yield path, st
+
+
+def expand_braces(pattern: str) -> Iterable[str]:
+    if "{" not in pattern:
+        return [pattern]
+    from braceexpand import braceexpand  # noqa: PLC0415
+
+    return braceexpand(pattern)
+
+
+class FileRecord:
+    """Compact description of a discovered file.
+
+    Records share the instrument or model configuration, and the Submission
+    holding the request state is only created when the file is processed.
+    """
+
+    __slots__ = ("path", "date", "size", "conf", "checksum")
+
+    def __init__(
+        self,
+        path: str,
+        date: datetime.date,
+        conf: Union[InstrumentConfig, ModelConfig],
+        size: int,
+        checksum: Optional[str] = None,
+    ):
+        self.path = path
+        self.date = date
+        self.conf = conf
+        self.size = size
+        self.checksum = checksum
+
+    @property
+    def site(self) -> str:
+        return self.conf.site
+
+    @property
+    def target(self) -> str:
+        if isinstance(self.conf, InstrumentConfig):
+            return self.conf.instrument
+        return self.conf.model
+
+    def sort_key(self) -> Tuple[datetime.date, str, str, str]:
+        return (self.date, self.site, self.target, self.path)
+
+    def shard(self, count: int) -> int:
+        """Return the shard (0 to count - 1) of the record.
+
+        All files of a site, instrument or model and date are in the same
+        shard, and the shard does not depend on the Python process.
+        """
+        key = f"{self.site}/{self.target}/{self.date.isoformat()}".encode()
+        return int.from_bytes(hashlib.md5(key).digest()[:8], "big") % count
+
+    def submission(
+        self, config: Config, context: Optional[SubmissionContext] = None
+    ) -> Submission:
+        sub = make_submission(config, self.date, self.conf, Path(self.path), context)
+        sub.metadata.checksum = self.checksum
+        sub.size = self.size
+        return sub
+
+
+DuplicateHandler = Callable[[FileRecord, str], None]
+RecordHandler = Callable[[FileRecord], None]
+DeferredHandler = Callable[[FileRecord, str], None]
+
+
+def iter_all_submissions(
+    configs: List[Config],
+    on_duplicate: Optional[DuplicateHandler] = None,
+    on_record: Optional[RecordHandler] = None,
+    on_deferred: Optional[DeferredHandler] = None,
+    context: Optional[SubmissionContext] = None,
+    seen: Optional["SeenFiles"] = None,
+) -> Iterator[Submission]:
+    """Merge the submissions of several configurations in date order.
+
+    A file found by several configurations is yielded only once.
+    """
+    if seen is None:
+        seen = SeenFiles()
+    streams = [
+        _config_records(config, on_duplicate, on_record, on_deferred, context, seen)
+        for config in configs
+    ]
+    for record, config in heapq.merge(*streams, key=_merge_key):
+        yield record.submission(config, context)
+
+
+def _merge_key(item: Tuple[FileRecord, Config]) -> Tuple[datetime.date, str, str, str]:
+    return item[0].sort_key()
+
+
+def _config_records(
+    config: Config,
+    on_duplicate: Optional[DuplicateHandler],
+    on_record: Optional[RecordHandler],
+    on_deferred: Optional[DeferredHandler],
+    context: Optional[SubmissionContext],
+    seen: "SeenFiles",
+) -> Iterator[Tuple[FileRecord, Config]]:
+    records = iter_records(config, on_duplicate, on_record, on_deferred, context, seen)
+    for record in records:
+        yield record, config
 
 
 def get_submissions(config: Config) -> List[Submission]:
-    submissions: List[Submission] = []
-    auth = (config.user_account.username, config.user_account.password)
-    for date, iconf in itertools.product(config.dates, config.instrument):
-        if iconf.periodicity != "daily":
-            continue
-        for f in get_files(date, iconf.path_fmt):
-            metadata_instrument = InstrumentMetadata(
-                site=iconf.site,
-                measurement_date=date,
-                filename=f.name,
-                checksum=None,
-                instrument=iconf.instrument,
-                instrument_pid=iconf.instrument_pid,
-                tags=iconf.tags,
-            )
-            submissions.append(
-                Submission(
-                    path=f,
-                    metadata=metadata_instrument,
-                    auth=auth,
-                    dataportal_config=config.dataportal_config,
-                    proxy_config=config.proxy_config,
-                )
-            )
+    return list(iter_submissions(config))
+
+
+def iter_submissions(
+    config: Config,
+    on_duplicate: Optional[DuplicateHandler] = None,
+    context: Optional[SubmissionContext] = None,
+    seen: Optional["SeenFiles"] = None,
+) -> Iterator[Submission]:
+    for record in iter_records(config, on_duplicate, context=context, seen=seen):
+        yield record.submission(config, context)
+
+
+def iter_records(
+    config: Config,
+    on_duplicate: Optional[DuplicateHandler] = None,
+    on_record: Optional[RecordHandler] = None,
+    on_deferred: Optional[DeferredHandler] = None,
+    context: Optional[SubmissionContext] = None,
+    seen: Optional["SeenFiles"] = None,
+) -> Iterator[FileRecord]:
+    """Discover files one date at a time.
+
+    Records are yielded in ascending date order and sorted within each date,
+    so uploads can start before the whole archive has been scanned. Monthly
+    files are yielded with the first date of their month.
+
+    A physical file matched by several patterns, e.g. through a symlink or
+    under two dates, is yielded only once. Pass the same `seen` to several
+    calls to skip the files already yielded by the others. `on_duplicate` is
+    called with the skipped record and the path of the file that was kept.
+
+    With `config.shard`, only the records of that shard are yielded.
+    `on_record` is called for every record before the shard is selected.
 
-    months = set(date.replace(day=1) for date in config.dates)
-    for date, iconf in itertools.product(months, config.instrument):
-        if iconf.periodicity != "monthly":
+    Files that may still be being written, see `StabilityCheck`, are not
+    yielded. `on_deferred` is called with each of them and the reason.
+
+    The time spent scanning is added to the metrics of `context`.
+    """
+    metrics = context.metrics if context is not None else None
+    if seen is None:
+        seen = SeenFiles()
+    stability = StabilityCheck(config.stability, on_deferred)
+    months: Set[datetime.date] = set()
+    for date in sorted(config.dates):
+        found: List[Tuple[FileRecord, os.stat_result]] = []
+        month = date.replace(day=1)
+        if month not in months:
+            months.add(month)
+            for iconf in config.instrument:
+                if iconf.periodicity == "monthly":
+                    found.extend(_scan(month, iconf, seen, on_duplicate, metrics))
+        for iconf in config.instrument:
+            if iconf.periodicity == "daily":
+                found.extend(_scan(date, iconf, seen, on_duplicate, metrics))
+        for mconf in config.model:
+            found.extend(_scan(date, mconf, seen, on_duplicate, metrics))
+        if on_record is not None:
+            for record, _ in found:
+                on_record(record)
+        if config.shard is not None:
+            index, count = config.shard
+            found = [(r, st) for r, st in found if r.shard(count) == index - 1]
+        batch = stability.select(found)
+        if len(batch) < len(found):
+            # Deferred files are claimed again when they are found complete.
+            ready = {id(record) for record in batch}
+            for record, st in found:
+                if id(record) not in ready:
+                    seen.release(record.path, st)
+        batch.sort(key=FileRecord.sort_key)
+        yield from batch
+
+
+class StabilityCheck:
+    """Hold back files that may still be being written.
+
+    A file is deferred if its completion marker, e.g. `file.nc.done` for
+    marker `.done`, does not exist or if it was modified less than `min_age`
+    seconds ago. Files modified within the last `probe` seconds are watched
+    until they are `probe` seconds old and deferred if they changed.
+    """
+
+    def __init__(
+        self, config: StabilityConfig, on_deferred: Optional[DeferredHandler] = None
+    ):
+        self.config = config
+        self.on_deferred = on_deferred
+
+    def select(
+        self, found: Iterable[Tuple[FileRecord, os.stat_result]]
+    ) -> List[FileRecord]:
+        """Return the records of files that are complete."""
+        now = time.time()
+        ready = []
+        pending = []
+        for record, st in found:
+            conf = record.conf
+            marker = conf.completion_marker
+            min_age = self.config.min_age if conf.min_age is None else conf.min_age
+            age = now - st.st_mtime
+            if marker and not os.path.exists(record.path + marker):
+                self._defer(record, f"no {marker} file")
+            elif age < min_age:
+                self._defer(record, f"modified {max(age, 0):.0f} s ago")
+            elif age < self.config.probe:
+                pending.append((record, st))
+            else:
+                ready.append(record)
+        if pending:
+            ready.extend(self._probe(pending))
+        return ready
+
+    def _probe(
+        self, pending: List[Tuple[FileRecord, os.stat_result]]
+    ) -> List[FileRecord]:
+        newest = max(st.st_mtime for _, st in pending)
+        wait = newest + self.config.probe - time.time()
+        time.sleep(min(max(wait, 0.0), self.config.probe))
+        stable = []
+        for record, st in pending:
+            try:
+                current = os.stat(record.path)
+            except OSError:
+                continue
+            if (current.st_size, current.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                stable.append(record)
+            else:
+                self._defer(record, "still being written")
+        return stable
+
+    def _defer(self, record: FileRecord, reason: str) -> None:
+        if self.on_deferred is not None:
+            self.on_deferred(record, reason)
+
+
+class SeenFiles:
+    """Files claimed for submission during a run, by device and inode.
+
+    A file is claimed once, whichever path, date or configuration it is found
+    under. A file modified after it was claimed can be claimed again, so that
+    files rewritten while watching are submitted again. The paths are only
+    kept with `keep_paths`, otherwise duplicates are reported with an empty
+    path. Safe to use from several threads.
+    """
+
+    def __init__(self, keep_paths: bool = True) -> None:
+        self.keep_paths = keep_paths
+        self._files: Dict[Union[Tuple[int, int], str], Tuple[int, str]] = {}
+        self._lock = threading.Lock()
+
+    def claim(self, path: str, st: os.stat_result) -> Optional[str]:
+        """Claim a file, returning the earlier path if it was already claimed."""
+        key = _file_key(path, st)
+        with self._lock:
+            claimed = self._files.get(key)
+            if claimed is not None and claimed[0] == st.st_mtime_ns:
+                return claimed[1]
+            self._files[key] = (st.st_mtime_ns, path if self.keep_paths else "")
+        return None
+
+    def release(self, path: str, st: os.stat_result) -> None:
+        """Forget a claim, so that the file can be claimed again."""
+        key = _file_key(path, st)
+        with self._lock:
+            claimed = self._files.get(key)
+            if claimed is not None and claimed[0] == st.st_mtime_ns:
+                del self._files[key]
+
+
+def _file_key(path: str, st: os.stat_result) -> Union[Tuple[int, int], str]:
+    # Some file systems on Windows do not have inode numbers.
+    return (st.st_dev, st.st_ino) if st.st_ino else os.path.realpath(path)
+
+
+def _scan(
+    date: datetime.date,
+    conf: Union[InstrumentConfig, ModelConfig],
+    seen: SeenFiles,
+    on_duplicate: Optional[DuplicateHandler],
+    metrics: Optional[Metrics],
+) -> List[Tuple[FileRecord, os.stat_result]]:
+    start = time.perf_counter()
+    records = []
+    marker = conf.completion_marker
+    for path, st in iter_files(date, conf.path_fmt):
+        if marker and path.endswith(marker):
             continue
-        for f in get_files(date, iconf.path_fmt):
-            metadata_instrument = InstrumentMetadata(
-                site=iconf.site,
-                measurement_date=date,
-                filename=f.name,
-                checksum=None,
-                instrument=iconf.instrument,
-                instrument_pid=iconf.instrument_pid,
-                tags=iconf.tags,
-            )
-            submissions.append(
-                Submission(
-                    path=f,
-                    metadata=metadata_instrument,
-                    auth=auth,
-                    dataportal_config=config.dataportal_config,
-                    proxy_config=config.proxy_config,
-                )
-            )
+        record = FileRecord(path, date, conf, st.st_size)
+        original = seen.claim(path, st)
+        if original is None:
+            records.append((record, st))
+        elif on_duplicate is not None:
+            on_duplicate(record, original)
+    if metrics is not None:
+        metrics.add("scan", time.perf_counter() - start, site=conf.site)
+    return records
 
-    for date, mconf in itertools.product(config.dates, config.model):
-        for f in get_files(date, mconf.path_fmt):
-            metadata_model = ModelMetadata(
-                site=mconf.site,
-                measurement_date=date,
-                filename=f.name,
-                checksum=None,
-                model=mconf.model,
-            )
-            submissions.append(
-                Submission(
-                    path=f,
-                    metadata=metadata_model,
-                    auth=auth,
-                    dataportal_config=config.dataportal_config,
-                    proxy_config=config.proxy_config,
+
+def make_submission(
+    config: Config,
+    date: datetime.date,
+    conf: Union[InstrumentConfig, ModelConfig],
+    path: Path,
+    context: Optional[SubmissionContext] = None,
+) -> Submission:
+    metadata: Union[InstrumentMetadata, ModelMetadata]
+    if isinstance(conf, InstrumentConfig):
+        metadata = InstrumentMetadata(
+            site=conf.site,
+            measurement_date=date,
+            filename=path.name,
+            checksum=None,
+            instrument=conf.instrument,
+            instrument_pid=conf.instrument_pid,
+            tags=conf.tags,
+        )
+    else:
+        metadata = ModelMetadata(
+            site=conf.site,
+            measurement_date=date,
+            filename=path.name,
+            checksum=None,
+            model=conf.model,
+        )
+    return Submission(
+        path=path,
+        metadata=metadata,
+        auth=(config.user_account.username, config.user_account.password),
+        dataportal_config=config.dataportal_config,
+        proxy_config=config.proxy_config,
+        validate=conf.validate,
+        context=context,
+    )
+
+
+class Summary:
+    """Counts of processed submissions, safe to update from several threads."""
+
+    def __init__(
+        self,
+        dry_run: bool,
+        shard: Optional[Tuple[int, int]] = None,
+        plan: Optional[Plan] = None,
+    ):
+        self.dry_run = dry_run
+        self.shard = shard
+        self.plan = plan
+        self.n_files = 0
+        self.n_fail = 0
+        self.dates: Set[datetime.date] = set()
+        self.n_duplicates = 0
+        self.duplicates: List[Tuple[str, str]] = []
+        self.deferred: List[Tuple[str, str]] = []
+        self.flagged: List[Tuple[str, str]] = []
+        self.left: List[str] = []
+        self.stopped = False
+        n_shards = shard[1] if shard else 0
+        self.shard_files = [0] * n_shards
+        self.shard_bytes = [0] * n_shards
+        self._lock = threading.Lock()
+
+    def add(self, sub: Submission) -> None:
+        with self._lock:
+            problem = sub.status.problem
+            if sub.status.deferred and problem is not None:
+                self.deferred.append((str(sub.path), problem))
+                return
+            if problem is not None:
+                self.flagged.append((str(sub.path), problem))
+            if self.dry_run or sub.status.ok:
+                self.n_files += 1
+                self.dates.add(sub.metadata.measurement_date)
+                if self.plan is not None:
+                    self.plan.add(sub)
+            else:
+                self.n_fail += 1
+
+    def add_duplicate(self, record: FileRecord, original: str) -> None:
+        with self._lock:
+            self.n_duplicates += 1
+            # Regular runs only report the count, so paths are not kept.
+            if self.dry_run:
+                self.duplicates.append((record.path, original))
+
+    def add_deferred(self, record: FileRecord, reason: str) -> None:
+        with self._lock:
+            self.deferred.append((record.path, reason))
+
+    def add_left(self, sub: Submission) -> None:
+        with self._lock:
+            self.left.append(str(sub.path))
+
+    def add_record(self, record: FileRecord) -> None:
+        if self.shard is None:
+            return
+        index = record.shard(self.shard[1])
+        with self._lock:
+            self.shard_files[index] += 1
+            self.shard_bytes[index] += record.size
+
+    def print(self) -> None:
+        n_files = self.n_files
+        n_fail = self.n_fail
+        n_dates = len(self.dates)
+        file_noun = "file" if n_files == 1 else "files"
+        date_noun = "date" if n_dates == 1 else "dates"
+        print("")
+        if self.n_duplicates > 0:
+            n_dup = self.n_duplicates
+            dup_noun = "file" if n_dup == 1 else "files"
+            if self.dry_run:
+                print(f"Skipped {n_dup} {dup_noun} found more than once:")
+                for path, original in self.duplicates:
+                    print(f"  {path} (same file as {original})")
+            else:
+                print(
+                    f"Skipped {n_dup} {dup_noun} found more than once "
+                    "(listed with --dry-run)."
                 )
+        if self.deferred:
+            n_def = len(self.deferred)
+            def_noun = "file" if n_def == 1 else "files"
+            print(f"Deferred {n_def} {def_noun} that may be incomplete:")
+            for path, reason in self.deferred:
+                print(f"  {path} ({reason})")
+        if self.flagged:
+            n_flag = len(self.flagged)
+            flag_noun = "file" if n_flag == 1 else "files"
+            print(f"Format checks flagged {n_flag} {flag_noun}:")
+            for path, reason in self.flagged:
+                print(f"  {path} ({reason})")
+        if self.dry_run and self.shard is not None:
+            self._print_shards()
+        if self.dry_run:
+            print(f"Would submit {n_files} {file_noun} to {n_dates} {date_noun}.")
+            if self.plan is not None:
+                self.plan.print()
+        elif n_files > 0:
+            print(
+                f"Submitted {n_files} {file_noun} successfully "
+                f"to {n_dates} {date_noun}."
+            )
+        elif n_fail == 0:
+            print("No files to submit.")
+        if n_fail > 0:
+            fail_noun = "file" if n_fail == 1 else "files"
+            print(
+                f"Failed to submit {n_fail} {fail_noun}. "
+                "Please check your configuration!"
             )
+        if self.left:
+            n_left = len(self.left)
+            left_noun = "file" if n_left == 1 else "files"
+            print(f"Deadline reached, left {n_left} {left_noun} for the next run:")
+            for path in self.left:
+                print(f"  {path}")
+            if self.stopped:
+                print("Files not found before the deadline are not listed.")
 
-    return submissions
+    def _print_shards(self) -> None:
+        if self.shard is None:
+            return
+        index, count = self.shard
+        print(f"{'Shard':>8} {'Files':>8} {'Size':>12}")
+        for i in range(count):
+            mark = "  (this shard)" if i == index - 1 else ""
+            print(
+                f"{i + 1:>4}/{count:<3} {self.shard_files[i]:>8} "
+                f"{self.shard_bytes[i] / 1e6:>9.1f} MB{mark}"
+            )
 
 
-def print_summary(submissions: List[Submission], dry_run: bool):
-    n_files = 0
-    n_fail = 0
-    dates = set()
+def print_summary(submissions: Iterable[Submission], dry_run: bool):
+    summary = Summary(dry_run)
     for sub in submissions:
-        if dry_run or sub.status.ok:
-            n_files += 1
-            dates.add(sub.metadata.measurement_date)
-        else:
-            n_fail += 1
-    n_dates = len(dates)
-    file_noun = "file" if n_files == 1 else "files"
-    date_noun = "date" if n_dates == 1 else "dates"
-    print("")
-    if dry_run:
-        print(f"Would submit {n_files} {file_noun} to {n_dates} {date_noun}.")
-    elif n_files > 0:
-        print(f"Submitted {n_files} {file_noun} successfully to {n_dates} {date_noun}.")
-    elif n_fail == 0:
-        print("No files to submit.")
-    if n_fail > 0:
-        fail_noun = "file" if n_fail == 1 else "files"
-        print(
-            f"Failed to submit {n_fail} {fail_noun}. Please check your configuration!"
-        )
+        summary.add(sub)
+    summary.print()
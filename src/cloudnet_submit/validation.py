@@ -0,0 +1,259 @@
+"""Quick checks of file headers to catch truncated files before uploading."""
+
+from __future__ import annotations
+
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import IO
+
+ACTIONS = ("warn", "defer")
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+# The HDF5 superblock may follow a user block of 512 bytes or a larger power of 2.
+HDF5_OFFSETS = (0, 512, 1024, 2048, 4096)
+NETCDF_EXTENSIONS = (".nc", ".nc4", ".cdf")
+
+# File codes of RPG FMCW radar level 0 and level 1 binary files.
+RPG_FILE_CODES = {789346, 889346, 789347, 889347, 889348}
+
+_NC_DIMENSION = 10
+_NC_VARIABLE = 11
+_NC_ATTRIBUTE = 12
+_NC_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+
+class FormatError(Exception):
+    pass
+
+
+def check_file(path: Path | str) -> str | None:
+    """Return why a file looks incomplete, or None if it looks fine.
+
+    Only headers are read: the sizes declared in NetCDF and HDF5 headers and
+    the header length of RPG binary files are compared with the file size.
+    Files in other formats are only checked for being empty.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return "empty file"
+        magic = f.read(8)
+        try:
+            if magic[:3] == b"CDF":
+                return _check_netcdf3(f, magic, size)
+            if _find_hdf5(f, magic, size) is not None:
+                return _check_hdf5(f, size)
+            if len(magic) >= 8:
+                code, header_len = struct.unpack("<iI", magic)
+                if code in RPG_FILE_CODES:
+                    return _check_rpg(header_len, size)
+        except (FormatError, IndexError, struct.error) as err:
+            return str(err) or "corrupt header"
+    if str(path).lower().endswith(NETCDF_EXTENSIONS):
+        return "not a NetCDF file"
+    return None
+
+
+def _find_hdf5(f: IO[bytes], magic: bytes, size: int) -> int | None:
+    for offset in HDF5_OFFSETS:
+        if offset + 8 > size:
+            return None
+        if offset > 0:
+            f.seek(offset)
+            magic = f.read(8)
+        if magic == HDF5_SIGNATURE:
+            return offset
+    return None
+
+
+def _check_hdf5(f: IO[bytes], size: int) -> str | None:
+    # The file is positioned right after the signature.
+    block = f.read(88)
+    version = block[0]
+    if version in (0, 1):
+        n_offset = block[5]
+        addresses = 16 if version == 0 else 20
+        flags = 0
+    elif version in (2, 3):
+        n_offset = block[1]
+        addresses = 4
+        flags = block[3]
+    else:
+        return None
+    if n_offset not in (2, 4, 8):
+        raise FormatError("corrupt HDF5 superblock")
+    fields = []
+    # Base address, free-space or superblock extension address, end of file.
+    for i in range(3):
+        pos = addresses + i * n_offset
+        fields.append(int.from_bytes(block[pos : pos + n_offset], "little"))
+    base, _, eof = fields
+    if eof == (1 << (8 * n_offset)) - 1:
+        return None
+    end = base + eof
+    if end > size:
+        return f"truncated HDF5 file, {size} of {end} bytes"
+    if version == 3 and flags & 0x1:
+        return "HDF5 file is still open for writing"
+    return None
+
+
+def _check_rpg(header_len: int, size: int) -> str | None:
+    # The header length excludes the file code and the length itself, and
+    # the data section starts with the number of samples.
+    end = 8 + header_len + 4
+    if end > size:
+        return f"truncated RPG file, {size} bytes but header needs {end}"
+    return None
+
+
+def _check_netcdf3(f: IO[bytes], magic: bytes, size: int) -> str | None:
+    version = magic[3]
+    if version not in (1, 2, 5):
+        raise FormatError(f"unknown NetCDF version {version}")
+    reader = _HeaderReader(f, magic[4:], size, version)
+    # Unknown record counts and sizes of huge variables are stored as all ones.
+    unknown = (1 << (8 * reader.n_bytes)) - 1
+    n_records = reader.count()
+    dims = reader.dimensions()
+    reader.attributes()
+    end = reader.tell()
+    record_start = None
+    record_size = 0
+    n_record_vars = 0
+    for is_record, vsize, begin in reader.variables(dims):
+        if is_record:
+            n_record_vars += 1
+            record_size += vsize
+            record_start = begin if record_start is None else min(record_start, begin)
+        elif vsize != unknown:
+            end = max(end, begin + vsize)
+    if record_start is not None and n_records != unknown:
+        if n_record_vars == 1:
+            # A single record variable is not padded to 4 bytes.
+            record_size = reader.last_record_size
+        end = max(end, record_start + n_records * record_size)
+    # The last variable does not need to be padded to 4 bytes.
+    if end - 3 > size:
+        return f"truncated NetCDF file, {size} of {end} bytes"
+    return None
+
+
+class _HeaderReader:
+    """Read the header of a classic NetCDF file (CDF-1, CDF-2 or CDF-5)."""
+
+    def __init__(self, f: IO[bytes], buffered: bytes, size: int, version: int):
+        self.f = f
+        self.size = size
+        self.version = version
+        self.n_bytes = 8 if version == 5 else 4
+        self.last_record_size = 0
+        self._buffer = buffered
+        self._pos = 4
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, n: int) -> bytes:
+        if n > self.size - self._pos:
+            raise FormatError("truncated NetCDF header")
+        if len(self._buffer) < n:
+            self._buffer += self.f.read(max(n - len(self._buffer), 8192))
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        self._pos += n
+        return data
+
+    def int32(self) -> int:
+        return int.from_bytes(self.read(4), "big")
+
+    def count(self) -> int:
+        return int.from_bytes(self.read(self.n_bytes), "big")
+
+    def name(self) -> None:
+        length = self.count()
+        self.read(_padded(length))
+
+    def list_header(self, tag: int) -> int:
+        found = self.int32()
+        n = self.count()
+        if found not in (0, tag) or (found == 0 and n != 0):
+            raise FormatError("corrupt NetCDF header")
+        return n
+
+    def dimensions(self) -> list[int]:
+        lengths = []
+        for _ in range(self.list_header(_NC_DIMENSION)):
+            self.name()
+            lengths.append(self.count())
+        return lengths
+
+    def attributes(self) -> None:
+        for _ in range(self.list_header(_NC_ATTRIBUTE)):
+            self.name()
+            nc_type = self.int32()
+            type_size = _NC_TYPE_SIZES.get(nc_type)
+            if type_size is None:
+                raise FormatError("corrupt NetCDF header")
+            self.read(_padded(self.count() * type_size))
+
+    def variables(self, dims: list[int]):
+        begin_bytes = 4 if self.version == 1 else 8
+        for _ in range(self.list_header(_NC_VARIABLE)):
+            self.name()
+            dim_ids = [self.count() for _ in range(self.count())]
+            self.attributes()
+            nc_type = self.int32()
+            vsize = self.count()
+            begin = int.from_bytes(self.read(begin_bytes), "big")
+            try:
+                is_record = bool(dim_ids) and dims[dim_ids[0]] == 0
+            except IndexError as err:
+                raise FormatError("corrupt NetCDF header") from err
+            if is_record:
+                self.last_record_size = _unpadded_size(dims, dim_ids[1:], nc_type)
+            yield is_record, vsize, begin
+
+
+def _padded(n: int) -> int:
+    return (n + 3) // 4 * 4
+
+
+def _unpadded_size(dims: list[int], dim_ids: list[int], nc_type: int) -> int:
+    size = _NC_TYPE_SIZES.get(nc_type, 1)
+    for dim_id in dim_ids:
+        size *= dims[dim_id]
+    return size
+
+
+class ValidationStats:
+    def __init__(self):
+        self.n_files = 0
+        self.n_problems = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def check(self, path: Path | str) -> str | None:
+        start = time.perf_counter()
+        try:
+            problem = check_file(path)
+        except OSError as err:
+            problem = f"cannot read file: {err.strerror}"
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.n_files += 1
+            self.n_problems += problem is not None
+            self.seconds += elapsed
+        return problem
+
+    def report(self) -> str | None:
+        if self.n_files == 0:
+            return None
+        noun = "file" if self.n_files == 1 else "files"
+        per_file = self.seconds / self.n_files * 1000
+        return (
+            f"Checked the format of {self.n_files} {noun} in {self.seconds:.2f} s "
+            f"({per_file:.2f} ms per file), {self.n_problems} suspicious"
+        )
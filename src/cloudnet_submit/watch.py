@@ -0,0 +1,418 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import datetime
+import glob
+import os
+import re
+import select
+import stat
+import struct
+import sys
+import time
+from dataclasses import dataclass
+from errno import ENOENT, ENOTDIR
+from typing import Iterator, Protocol
+
+from braceexpand import braceexpand
+
+from .cfg import Config, InstrumentConfig, ModelConfig
+from .submission import Submission, SubmissionContext
+from .utils import FileRecord, SeenFiles, get_files, iter_submissions
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_EVENT = struct.Struct("iIII")
+_DIRECTIVES = {"Y": r"\d{4}", "y": r"\d{2}", "m": r"\d{2}", "d": r"\d{2}"}
+
+
+@dataclass
+class Target:
+    conf: InstrumentConfig | ModelConfig
+    pattern: re.Pattern[str]
+    fmt: str
+    root: str
+
+    def match(self, path: str) -> datetime.date | None:
+        m = self.pattern.fullmatch(path)
+        if m is None:
+            return None
+        groups = m.groupdict()
+        year = int(groups["Y"]) if groups.get("Y") else 2000 + int(groups["y"])
+        try:
+            return datetime.date(year, int(groups["m"]), int(groups.get("d") or 1))
+        except ValueError:
+            return None
+
+
+class Watcher(Protocol):
+    overflowed: bool
+
+    def events(self, timeout: float) -> list[str]: ...
+
+    def close(self) -> None: ...
+
+
+def make_targets(config: Config) -> list[Target]:
+    confs: list[InstrumentConfig | ModelConfig] = [*config.instrument, *config.model]
+    targets = []
+    for conf in confs:
+        for expanded in braceexpand(conf.path_fmt):
+            fmt = os.path.abspath(expanded)
+            targets.append(Target(conf, fmt_to_regex(fmt), fmt, _static_root(fmt)))
+    return targets
+
+
+def fmt_to_regex(fmt: str) -> re.Pattern[str]:
+    """Translate a path_fmt with glob wildcards to a regular expression."""
+    parts = []
+    seen = set()
+    i = 0
+    while i < len(fmt):
+        char = fmt[i]
+        if char == "%" and i + 1 < len(fmt) and fmt[i + 1] in _DIRECTIVES:
+            name = fmt[i + 1]
+            parts.append(
+                f"(?P={name})" if name in seen else f"(?P<{name}>{_DIRECTIVES[name]})"
+            )
+            seen.add(name)
+            i += 2
+            continue
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and "]" in fmt[i + 2 :]:
+            end = fmt.index("]", i + 2)
+            chars = fmt[i + 1 : end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            parts.append(f"[{chars.replace(chr(92), chr(92) * 2)}]")
+            i = end
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return re.compile("".join(parts))
+
+
+def _static_root(fmt: str) -> str:
+    static: list[str] = []
+    for component in fmt.split(os.sep):
+        if re.search(r"%[a-zA-Z]|[*?\[]", component):
+            break
+        static.append(component)
+    root = os.sep.join(static) or os.sep
+    while not os.path.isdir(root):
+        root = os.path.dirname(root)
+    return root
+
+
+def _date_dirs(target: Target, date: datetime.date) -> list[str]:
+    """Return the existing directories leading from the root to the files of a date."""
+    components = date.strftime(os.path.dirname(target.fmt)).split(os.sep)
+    dirs: list[str] = []
+    for i in range(1, len(components) + 1):
+        prefix = os.sep.join(components[:i])
+        if len(prefix) > len(target.root):
+            dirs.extend(d for d in glob.glob(prefix) if os.path.isdir(d))
+    return dirs
+
+
+def watch_submissions(
+    config: Config,
+    settle: float = 5.0,
+    watcher: Watcher | None = None,
+    context: SubmissionContext | None = None,
+    seen: SeenFiles | None = None,
+) -> Iterator[Submission]:
+    """Yield submissions for files as soon as they have been written.
+
+    A file is submitted once no writes to it have been seen for `settle`
+    seconds. Files already claimed in `seen`, e.g. by the discovery that ran
+    before watching, are skipped unless they have been rewritten since, like
+    monthly files.
+    """
+    if seen is None:
+        seen = SeenFiles()
+    targets = make_targets(config)
+    if watcher is None:
+        watcher = make_watcher(config, targets, settle)
+    pending: dict[str, float] = {}
+    try:
+        while True:
+            now = time.monotonic()
+            timeout = min(pending.values()) - now if pending else 1.0
+            try:
+                paths = watcher.events(max(0.0, timeout))
+            except OSError as err:
+                watcher.close()
+                watcher = _polling_fallback(config, settle, err)
+                # Look for the files written before polling started.
+                watcher.overflowed = True
+                paths = []
+            for path in paths:
+                pending[path] = time.monotonic() + settle
+            if watcher.overflowed:
+                watcher.overflowed = False
+                pending.clear()
+                yield from iter_submissions(config, context=context, seen=seen)
+                continue
+            now = time.monotonic()
+            for path in [path for path, ready in pending.items() if ready <= now]:
+                del pending[path]
+                yield from _matching_submissions(
+                    config, targets, path, pending, context, seen
+                )
+    finally:
+        watcher.close()
+
+
+def _matching_submissions(
+    config: Config,
+    targets: list[Target],
+    path: str,
+    pending: dict[str, float],
+    context: SubmissionContext | None,
+    seen: SeenFiles,
+) -> Iterator[Submission]:
+    for target in targets:
+        data_path = path
+        marker = target.conf.completion_marker
+        if marker:
+            # The data file is submitted once its marker file appears.
+            if not path.endswith(marker):
+                continue
+            data_path = path[: -len(marker)]
+        record = match_record(target, data_path)
+        if record is None:
+            continue
+        wait = _time_to_min_age(config, record)
+        if wait > 0:
+            # Look at the file again once it is old enough.
+            pending[path] = time.monotonic() + wait
+            continue
+        try:
+            st = os.stat(record.path)
+        except OSError:
+            continue
+        # Also skips the file when several targets match it.
+        if seen.claim(record.path, st) is None:
+            yield record.submission(config, context)
+
+
+def _time_to_min_age(config: Config, record: FileRecord) -> float:
+    min_age = record.conf.min_age
+    if min_age is None:
+        min_age = config.stability.min_age
+    try:
+        mtime = os.stat(record.path).st_mtime
+    except OSError:
+        return 0.0
+    return mtime + min_age - time.time()
+
+
+def match_record(target: Target, path: str) -> FileRecord | None:
+    """Return a record if an existing file matches the target."""
+    today = _today()
+    date = target.match(path)
+    if date is None or date > today:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    if (
+        isinstance(target.conf, InstrumentConfig)
+        and target.conf.periodicity == "monthly"
+    ):
+        date = date.replace(day=1)
+    return FileRecord(path, date, target.conf, st.st_size)
+
+
+def _today() -> datetime.date:
+    return datetime.datetime.now(tz=datetime.timezone.utc).date()
+
+
+def make_watcher(config: Config, targets: list[Target], interval: float) -> Watcher:
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(targets)
+        except OSError as err:
+            return _polling_fallback(config, interval, err)
+    return PollingWatcher(config, interval)
+
+
+def _polling_fallback(config: Config, interval: float, err: OSError) -> Watcher:
+    print(f"Cannot watch files with inotify ({err}), polling instead.", file=sys.stderr)
+    return PollingWatcher(config, interval)
+
+
+class InotifyWatcher:
+    """Report files closed after writing or moved into the watched directories.
+
+    Only the directories that the current and previous date resolve to are
+    watched, with the directories leading to them from the static root of
+    each `path_fmt`, so the number of watches does not grow with the archive.
+    The watches move along when the date changes. Raises OSError if a
+    directory cannot be watched, e.g. when `fs.inotify.max_user_watches` has
+    been reached.
+    """
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, targets: list[Target]):
+        self.overflowed = False
+        self._targets = targets
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1: {os.strerror(errno)}")
+        self._watches: dict[int, str] = {}
+        self._dirs: dict[str, int] = {}
+        self._found: list[str] = []
+        self._today = _today()
+        try:
+            self._update(report=False)
+        except OSError:
+            self.close()
+            raise
+
+    def events(self, timeout: float) -> list[str]:
+        today = _today()
+        if today != self._today:
+            self._today = today
+            self._update(report=True)
+        paths, self._found = self._found, []
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return paths
+        new_dirs = False
+        while True:
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            new_dirs |= self._parse(buffer, paths)
+        if new_dirs:
+            self._update(report=True)
+        paths.extend(self._found)
+        self._found = []
+        return paths
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _parse(self, buffer: bytes, paths: list[str]) -> bool:
+        """Add the written files to `paths` and tell if directories were added."""
+        new_dirs = False
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                self._dirs = {d: w for d, w in self._dirs.items() if w != wd}
+                continue
+            if wd not in self._watches:
+                continue
+            if mask & IN_ISDIR:
+                new_dirs = True
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                paths.append(os.path.join(self._watches[wd], name))
+        return new_dirs
+
+    def _update(self, report: bool) -> None:
+        """Watch the directories of the current and previous date only."""
+        wanted: set[str] = set()
+        for target in self._targets:
+            wanted.add(target.root)
+            for date in (self._today - datetime.timedelta(days=1), self._today):
+                wanted.update(_date_dirs(target, date))
+        for directory in self._dirs.keys() - wanted:
+            wd = self._dirs.pop(directory)
+            if wd not in self._dirs.values():
+                self._watches.pop(wd, None)
+                self._libc.inotify_rm_watch(self._fd, wd)
+        for directory in sorted(wanted - self._dirs.keys()):
+            self._add(directory, report)
+
+    def _add(self, directory: str, report: bool) -> None:
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), ctypes.c_uint32(self.mask)
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno in (ENOENT, ENOTDIR):
+                # The directory was removed in the meantime.
+                return
+            raise OSError(errno, f"inotify_add_watch: {os.strerror(errno)}", directory)
+        self._watches[wd] = directory
+        self._dirs[directory] = wd
+        if not report:
+            return
+        # Files may have been written before the directory was watched.
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        self._found.extend(e.path for e in entries if e.is_file(follow_symlinks=True))
+
+
+class PollingWatcher:
+    """Fallback for systems without inotify: compare file listings periodically."""
+
+    def __init__(self, config: Config, interval: float):
+        self.overflowed = False
+        self.config = config
+        self.interval = max(interval, 1.0)
+        self._last_poll = time.monotonic()
+        self._seen = self._scan()
+
+    def events(self, timeout: float) -> list[str]:
+        wait = self._last_poll + self.interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, wait))
+        self._last_poll = time.monotonic()
+        seen = self._scan()
+        changed = [path for path, stat in seen.items() if self._seen.get(path) != stat]
+        self._seen = seen
+        return changed
+
+    def close(self) -> None:
+        pass
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        today = _today()
+        dates = [today - datetime.timedelta(days=1), today]
+        seen = {}
+        confs: list[InstrumentConfig | ModelConfig] = [
+            *self.config.instrument,
+            *self.config.model,
+        ]
+        for conf in confs:
+            for date in dates:
+                for path in get_files(date, conf.path_fmt):
+                    try:
+                        stat = path.stat()
+                    except OSError:
+                        continue
+                    key = os.path.abspath(path)
+                    seen[key] = (stat.st_size, stat.st_mtime_ns)
+        return seen
@@ -1,3 +1,4 @@
+import hashlib
 import pathlib
 import shutil
 import sys
@@ -5,10 +6,17 @@ import sys
 import pytest
 import requests
 
+from benchmarks.portal import Portal
+
 from .cfg import test_config_fname
 from .generate_testdata import generate_testdata
 
 
+@pytest.fixture(autouse=True)
+def isolate_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path.joinpath("cache")))
+
+
 @pytest.fixture
 def make_test_dir(tmp_path, monkeypatch):
     monkeypatch.chdir(tmp_path)
@@ -41,7 +49,7 @@ def capture_stdout(monkeypatch):
 
 @pytest.fixture
 def mock_request(monkeypatch):
-    reqs: dict = {"checksums": []}
+    reqs: dict = {"checksums": [], "uploads": []}
 
     class Req:
         def __init__(self, ok=True, status_code=200):
@@ -62,13 +70,31 @@ def mock_request(monkeypatch):
             else:
                 self.text = "-"
 
+        def json(self):
+            return []
+
     def mock_post(*args, **kwargs):
         reqs["checksums"].append(kwargs["json"]["checksum"])
         return Req()
 
-    def mock_put(*args, **kwargs):
+    def mock_put(self, url, *args, **kwargs):
+        checksum = hashlib.md5(kwargs["data"].read()).hexdigest()
+        reqs["uploads"].append((url, checksum))
         return Req(status_code=201)
 
+    def mock_get(*args, **kwargs):
+        # An empty file listing, so the preflight finds nothing uploaded.
+        return Req()
+
+    monkeypatch.setattr(requests.Session, "get", mock_get)
     monkeypatch.setattr(requests.Session, "post", mock_post)
     monkeypatch.setattr(requests.Session, "put", mock_put)
     return reqs
+
+
+@pytest.fixture
+def portal():
+    server = Portal()
+    server.start()
+    yield server
+    server.stop()
@@ -1,10 +1,55 @@
+import datetime
+import errno
+import hashlib
+import io
+import json
+import os
+import pathlib
+import struct
+import sys
+import time
+from datetime import timedelta
 from unittest.mock import patch
 
 import pytest
 
-from cloudnet_submit.cfg import DEFAULT_CONFIG_FNAME, EXAMPLE_CONFIG_FNAME, get_config
+from benchmarks.portal import Portal
+from benchmarks.run import load_results
+from benchmarks.run import run as run_benchmarks
+from benchmarks.startup import profile_command
+from cloudnet_submit import Client, load_configs
+from cloudnet_submit.cache import ChecksumCache, FileKey
+from cloudnet_submit.cfg import (
+    DEFAULT_CONFIG_FNAME,
+    EXAMPLE_CONFIG_FNAME,
+    BandwidthConfig,
+    BandwidthProfile,
+    DataportalConfig,
+    ProxyConfig,
+    TimeoutConfig,
+    get_config,
+    parse_rate,
+)
+from cloudnet_submit.checksum import ChecksumEngine, compute_checksum
 from cloudnet_submit.generate_config import generate_config
-from cloudnet_submit.utils import get_submissions
+from cloudnet_submit.main import EXIT_DEADLINE, main
+from cloudnet_submit.submission import ModelMetadata, Submission, SubmissionContext
+from cloudnet_submit.throttle import (
+    ThrottledReader,
+    TokenBucket,
+    TransferStalled,
+    WatchedReader,
+)
+from cloudnet_submit.utils import get_submissions, iter_records, iter_submissions
+from cloudnet_submit.validation import HDF5_SIGNATURE, check_file
+from cloudnet_submit.watch import (
+    InotifyWatcher,
+    PollingWatcher,
+    fmt_to_regex,
+    make_targets,
+    make_watcher,
+    watch_submissions,
+)
 
 from .cfg import test_config_fname
 
@@ -32,3 +77,767 @@ def test_submissions(make_data, mock_request):
     sent_checksums = set([s.metadata.checksum for s in submissions])
     assert len(received_checksums) == len(generated_files)
     assert received_checksums == sent_checksums
+
+
+def test_concurrent_submissions(make_data, mock_request):
+    with patch("sys.argv", ["prog", "--config", test_config_fname, "--jobs", "4"]):
+        main()
+    generated_files = set(p.resolve() for p in make_data)
+    generated_checksums = set(compute_checksum(p) for p in generated_files)
+    assert len(mock_request["checksums"]) == len(generated_files)
+    assert set(mock_request["checksums"]) == generated_checksums
+
+
+def test_checksum_cache(tmp_path):
+    path = tmp_path.joinpath("file.txt")
+    path.write_text("first")
+    cache = ChecksumCache(tmp_path.joinpath("checksums.sqlite"), timedelta(days=1))
+    key = FileKey.from_path(path)
+    assert cache.get(key) is None
+    cache.set(key, compute_checksum(path))
+    assert cache.get(FileKey.from_path(path)) == compute_checksum(path)
+    path.write_text("second, longer")
+    assert cache.get(FileKey.from_path(path)) is None
+    cache.evict(timedelta(0))
+    assert cache.get(key) is None
+    cache.close()
+
+
+def test_cached_checksums_skip_reading(make_data, mock_request):
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        main()
+    with patch("sys.argv", ["prog", "--config", test_config_fname]), patch(
+        "cloudnet_submit.checksum.compute_checksum"
+    ) as mock_checksum:
+        main()
+    mock_checksum.assert_not_called()
+
+
+def test_ledger_skips_submitted_files(make_data, mock_request):
+    argv = ["prog", "--config", test_config_fname]
+    with patch("sys.argv", argv):
+        main()
+    n_files = len(mock_request["checksums"])
+    with patch("sys.argv", argv):
+        main()
+    assert len(mock_request["checksums"]) == n_files
+    with patch("sys.argv", [*argv, "--ignore-ledger"]):
+        main()
+    assert len(mock_request["checksums"]) == 2 * n_files
+    with patch("sys.argv", [*argv, "--no-cache"]):
+        main()
+    assert len(mock_request["checksums"]) == 3 * n_files
+    with patch("sys.argv", [*argv, "--host", "http://localhost:8080"]):
+        main()
+    assert len(mock_request["checksums"]) == 4 * n_files
+
+
+def test_checksum_engine(tmp_path):
+    paths = [tmp_path.joinpath(f"{i}.bin") for i in range(8)]
+    for i, path in enumerate(paths):
+        path.write_bytes(bytes([i]) * 3_000_000)
+    engine = ChecksumEngine(workers=4)
+    engine.prefetch(paths)
+    checksums = [engine.checksum(path) for path in paths]
+    engine.close()
+    assert checksums == [hashlib.md5(p.read_bytes()).hexdigest() for p in paths]
+    assert engine.n_files == len(paths)
+    assert "MB/s" in str(engine.report())
+
+
+def test_single_read(make_data, mock_request, monkeypatch):
+    opened = []
+    path_open = pathlib.Path.open
+
+    def spy_open(self, *args, **kwargs):
+        opened.append(self)
+        return path_open(self, *args, **kwargs)
+
+    monkeypatch.setattr(pathlib.Path, "open", spy_open)
+    with patch("sys.argv", ["prog", "--config", test_config_fname, "--single-read"]):
+        main()
+    assert len(mock_request["uploads"]) == len(mock_request["checksums"])
+    for url, checksum in mock_request["uploads"]:
+        assert url.endswith(checksum)
+    assert len(opened) == len(set(opened)) == len(mock_request["uploads"])
+
+
+def test_submissions_are_streamed_in_order(make_data):
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        config = get_config()
+    paths = [sub.path for sub in iter_submissions(config)]
+    assert paths == [sub.path for sub in iter_submissions(config)]
+    dates = [sub.metadata.measurement_date for sub in iter_submissions(config)]
+    assert dates == sorted(dates)
+
+
+def test_dry_run_does_not_import_http_libraries(make_data):
+    args = ["--dry-run", "--config", test_config_fname]
+    env = {"XDG_CACHE_HOME": os.environ["XDG_CACHE_HOME"]}
+    profile = profile_command(args, pathlib.Path.cwd(), env)
+    assert "cloudnet_submit.main" in profile.imports
+    # The test configuration uses braces in path_fmt.
+    assert set(profile.unexpected()) <= {"braceexpand"}
+
+
+def test_file_records(make_data):
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        config = get_config()
+    records = list(iter_records(config))
+    assert len(records) == len(set(p.resolve() for p in make_data))
+    for record in records:
+        assert record.size == os.stat(record.path).st_size
+        sub = record.submission(config)
+        assert sub.path == pathlib.Path(record.path)
+        assert sub.metadata.site is record.site
+
+
+def test_duplicate_files_are_submitted_once(make_data, mock_request, capture_stdout):
+    os.symlink("mace-head/chm15k", "data/latest")
+    with open(test_config_fname, "a") as f:
+        f.write(
+            '\n[[instrument]]\nsite = "mace-head"\ninstrument = "chm15k"\n'
+            'instrument_pid = "pidstring"\n'
+            'path_fmt = "data/latest/%Y/%m/%Y%m%d_MaceHead_CHM.nc"\n'
+        )
+    n_files = len(set(p.resolve() for p in make_data))
+    with patch("sys.argv", ["prog", "--config", test_config_fname, "--dry-run"]):
+        main()
+    assert "Skipped 3 files found more than once" in capture_stdout["stdout"]
+    assert f"Would submit {n_files} files" in capture_stdout["stdout"]
+    assert "(same file as " in capture_stdout["stdout"]
+    capture_stdout["stdout"] = ""
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        main()
+    assert len(mock_request["uploads"]) == n_files
+    assert "Skipped 3 files found more than once" in capture_stdout["stdout"]
+    assert "(same file as " not in capture_stdout["stdout"]
+
+
+def test_files_found_under_several_dates_are_submitted_once(make_data):
+    with open(test_config_fname, "a") as f:
+        f.write(
+            '\n[[instrument]]\nsite = "mace-head"\ninstrument = "chm15k"\n'
+            'instrument_pid = "pidstring"\n'
+            'path_fmt = "data/mace-head/chm15k/%Y/%m/*_MaceHead_CHM.nc"\n'
+            'periodicity = "monthly"\n'
+        )
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        config = get_config()
+    duplicates = []
+    records = list(iter_records(config, lambda r, _: duplicates.append(r)))
+    paths = [os.path.realpath(record.path) for record in records]
+    assert len(paths) == len(set(paths)) == len(set(p.resolve() for p in make_data))
+    assert duplicates
+
+
+def test_spooled_files_are_not_discovered_again(make_data, portal, capture_stdout):
+    with open(test_config_fname, "a") as f:
+        f.write("\n[spool]\nmin_backoff = 0\n")
+    portal.injected.append((500, {}))
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    argv += ["--no-preflight"]
+    with patch("sys.argv", argv), pytest.raises(SystemExit):
+        main()
+    # The same files are also found through a symlink, under another date.
+    os.symlink("mace-head", "data/alias")
+    with open(test_config_fname, "a") as f:
+        f.write(
+            '\n[[instrument]]\nsite = "mace-head"\ninstrument = "chm15k"\n'
+            'instrument_pid = "pidstring"\n'
+            'path_fmt = "data/alias/chm15k/%Y/%m/*_MaceHead_CHM.nc"\n'
+            'periodicity = "monthly"\n'
+        )
+    n_posts = portal.count("POST")
+    with patch("sys.argv", [*argv, "--ignore-ledger"]):
+        main()
+    assert "Retrying 1 file that failed" in capture_stdout["stdout"]
+    n_files = len(set(p.resolve() for p in make_data))
+    assert portal.count("POST") == n_posts + n_files
+
+
+def test_several_configs(make_data, portal, capture_stdout):
+    stations = pathlib.Path("stations")
+    stations.mkdir()
+    text = pathlib.Path(test_config_fname).read_text()
+    header, *sections = text.split("\n\n")
+    for i, section in enumerate(sections):
+        user = header.replace("alice", f"station{i}")
+        (stations / f"{i}.toml").write_text(f"{user}\n\n{section}\n")
+    argv = ["prog", "--config", str(stations), "--host", portal.url]
+    with patch("sys.argv", argv):
+        main()
+    n_files = len(set(p.resolve() for p in make_data))
+    assert portal.count("GET") == len(sections)
+    assert portal.count("POST") == portal.count("PUT") == n_files
+    assert f"Submitted {n_files} files successfully" in capture_stdout["stdout"]
+
+
+def test_shards(make_data, capture_stdout):
+    argv = ["prog", "--config", test_config_fname]
+    with patch("sys.argv", argv):
+        paths = {sub.path for sub in iter_submissions(get_config())}
+    shards = []
+    for i in (1, 2, 3):
+        with patch("sys.argv", [*argv, "--shard", f"{i}/3"]):
+            config = get_config()
+        shards.append({sub.path for sub in iter_submissions(config)})
+    assert set.union(*shards) == paths
+    assert sum(len(shard) for shard in shards) == len(paths)
+    with patch("sys.argv", [*argv, "--shard", "2/3", "--dry-run"]):
+        main()
+    assert f"Would submit {len(shards[1])} " in capture_stdout["stdout"]
+    assert "(this shard)" in capture_stdout["stdout"]
+
+
+def test_files_being_written_are_deferred(make_data, capture_stdout):
+    paths = sorted(set(p.resolve() for p in make_data))
+    hour_ago = time.time() - 3600
+    for path in paths:
+        os.utime(path, (hour_ago, hour_ago))
+    os.utime(paths[0])
+    argv = ["prog", "--config", test_config_fname, "--min-age", "60", "--dry-run"]
+    with patch("sys.argv", argv):
+        config = get_config()
+        main()
+    deferred = []
+    records = list(iter_records(config, on_deferred=lambda r, _: deferred.append(r)))
+    assert [pathlib.Path(r.path).resolve() for r in deferred] == [paths[0]]
+    assert len(records) == len(paths) - 1
+    assert "Deferred 1 file that may be incomplete" in capture_stdout["stdout"]
+
+    os.utime(paths[0], (hour_ago, hour_ago))
+    for conf in config.instrument:
+        conf.completion_marker = ".done"
+    done = [r.path for r in records if r.conf in config.instrument][:2]
+    for path in done:
+        pathlib.Path(path + ".done").touch()
+    records = list(iter_records(config))
+    n_models = len([r for r in records if r.conf in config.model])
+    assert sorted(r.path for r in records if r.conf in config.instrument) == sorted(
+        done
+    )
+    assert n_models > 0
+
+
+def _classic_netcdf(n_values: int) -> bytes:
+    """Return a NetCDF-3 file with one int variable of `n_values` values."""
+
+    def name(text: bytes) -> bytes:
+        return struct.pack(">i", len(text)) + text.ljust((len(text) + 3) // 4 * 4)
+
+    header = b"CDF\x01" + struct.pack(">i", 0)
+    header += struct.pack(">ii", 10, 1) + name(b"x") + struct.pack(">i", n_values)
+    header += struct.pack(">ii", 0, 0)
+    header += struct.pack(">ii", 11, 1) + name(b"v") + struct.pack(">ii", 1, 0)
+    header += struct.pack(">iiii", 0, 0, 4, 4 * n_values)
+    begin = len(header) + 4
+    return header + struct.pack(">i", begin) + bytes(4 * n_values)
+
+
+def test_format_checks(tmp_path):
+    path = tmp_path / "file.nc"
+    netcdf = _classic_netcdf(100)
+    path.write_bytes(netcdf)
+    assert check_file(path) is None
+    path.write_bytes(netcdf[:-8])
+    assert "truncated NetCDF file" in str(check_file(path))
+    path.write_bytes(b"plain text")
+    assert check_file(path) == "not a NetCDF file"
+    path.write_bytes(b"")
+    assert check_file(path) == "empty file"
+
+    superblock = HDF5_SIGNATURE + bytes([2, 8, 8, 0])
+    superblock += struct.pack("<QQQQ", 0, 2**64 - 1, 4096, 48) + bytes(4)
+    path.write_bytes(superblock.ljust(4096, b"\0"))
+    assert check_file(path) is None
+    path.write_bytes(superblock.ljust(1000, b"\0"))
+    assert "truncated HDF5 file" in str(check_file(path))
+
+    path = tmp_path / "radar.lv1"
+    header = struct.pack("<iI", 889346, 200)
+    path.write_bytes(header + bytes(204))
+    assert check_file(path) is None
+    path.write_bytes(header + bytes(100))
+    assert "truncated RPG file" in str(check_file(path))
+
+
+def test_suspicious_files_are_deferred(make_data, mock_request, capture_stdout):
+    config = pathlib.Path(test_config_fname)
+    text = config.read_text().replace(
+        'instrument     = "chm15k"', 'instrument     = "chm15k"\nvalidate = "defer"'
+    )
+    config.write_text(text)
+    chm15k = sorted(p for p in make_data if "chm15k" in str(p))
+    chm15k[0].write_bytes(_classic_netcdf(10))
+    n_files = len(set(p.resolve() for p in make_data))
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        main()
+    assert len(mock_request["uploads"]) == n_files - 2
+    stdout = capture_stdout["stdout"]
+    assert "Deferred 2 files that may be incomplete" in stdout
+    assert "(not a NetCDF file)" in stdout
+    assert "Checked the format of 3 files" in stdout
+
+
+def test_dry_run_plan(make_data, portal, capture_stdout):
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    n_files = len(set(p.resolve() for p in make_data))
+    with patch("sys.argv", [*argv, "--dry-run"]):
+        main()
+    stdout = capture_stdout["stdout"]
+    assert f"Total {n_files:>42}" in stdout
+    assert "Largest files:" in stdout
+    assert "Use --limit-rate or a previous run" in stdout
+    assert not portal.requests
+    with patch("sys.argv", [*argv, "--no-cache"]):
+        main()
+    assert not list(pathlib.Path(os.environ["XDG_CACHE_HOME"]).rglob("*.json"))
+    portal.files.clear()
+    with patch("sys.argv", argv):
+        main()
+    with patch("sys.argv", [*argv, "--dry-run", "--limit-rate", "1kB/s"]):
+        main()
+    assert "at 1.0 kB/s" in capture_stdout["stdout"]
+    assert "(run of " in capture_stdout["stdout"]
+
+
+def test_client(make_data, portal, capture_stdout):
+    configs = load_configs([test_config_fname], ["--host", portal.url])
+    paths = sorted(p for p in make_data if "chm15k" in str(p))
+    n_files = len(set(p.resolve() for p in make_data))
+    with Client(configs) as client:
+        with Client(configs) as other:
+            assert other.context.health is not client.context.health
+        with pytest.raises(ValueError):
+            client.submit_files([test_config_fname])
+        results = client.submit_files(paths)
+        assert [r.path.resolve() for r in results] == [p.resolve() for p in paths]
+        assert all(r.ok and r.status.metadata == 200 for r in results)
+        dates = [r.metadata.measurement_date for r in results]
+        results = client.submit_dates(dates, jobs=4)
+        assert len(results) == n_files
+        assert all(r.ok for r in results)
+        skipped = [r for r in results if r.status.metadata_msg == "Already submitted"]
+        assert len(skipped) == len(paths)
+        assert len(client.context.session_pools) == 1
+    assert portal.count("PUT") == n_files
+    assert not client.context.session_pools
+    assert "[meta:" not in capture_stdout["stdout"]
+
+
+def test_deferred_file_is_hashed_again_when_rewritten(make_data, portal):
+    config = pathlib.Path(test_config_fname)
+    text = config.read_text().replace(
+        'instrument     = "chm15k"', 'instrument     = "chm15k"\nvalidate = "defer"'
+    )
+    config.write_text(text)
+    path = sorted(p for p in make_data if "chm15k" in str(p))[0]
+    configs = load_configs([test_config_fname], ["--host", portal.url])
+    with Client(configs) as client:
+        (result,) = client.submit_files([path])
+        assert result.status.deferred
+        path.write_bytes(_classic_netcdf(10))
+        (result,) = client.submit_files([path])
+    assert result.ok
+    assert portal.files[compute_checksum(path)]["status"] == "uploaded"
+
+
+def test_client_can_be_opened_after_failed_setup(make_data):
+    pathlib.Path("not-a-directory").touch()
+    with open(test_config_fname, "a") as f:
+        f.write('\n[cache]\nenabled = false\ndirectory = "not-a-directory/cache"\n')
+    configs = load_configs([test_config_fname])
+    with pytest.raises(OSError):
+        Client(configs)
+    Client(load_configs([test_config_fname], ["--no-spool"])).close()
+
+
+def test_preflight_skips_uploaded_files(make_data, portal):
+    uploaded = make_data[0]
+    portal.add_file(
+        site="mace-head",
+        instrument="chm15k",
+        filename=uploaded.name,
+        measurementDate=datetime.datetime.strptime(uploaded.name[:8], "%Y%m%d")
+        .date()
+        .isoformat(),
+        checksum=compute_checksum(uploaded),
+    )
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    with patch("sys.argv", [*argv, "--no-cache"]):
+        main()
+    n_files = len(set(p.resolve() for p in make_data))
+    assert portal.count("GET") == 4
+    assert portal.count("POST") == n_files - 1
+    assert portal.count("PUT") == n_files - 1
+
+
+def test_preflight_falls_back_without_listing(make_data, portal):
+    portal.listing_available = False
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    with patch("sys.argv", [*argv, "--no-cache"]):
+        main()
+    n_files = len(set(p.resolve() for p in make_data))
+    assert portal.count("POST") == n_files
+    assert portal.count("PUT") == n_files
+
+
+def test_path_fmt_to_regex():
+    pattern = fmt_to_regex("/data/%Y/%m/%y%m%d_*_P10_ZEN.LV[01]")
+    match = pattern.fullmatch("/data/2024/01/240115_000001_P10_ZEN.LV1")
+    assert match is not None
+    assert match.group("Y", "m", "d") == ("2024", "01", "15")
+    assert pattern.fullmatch("/data/2024/02/240115_000001_P10_ZEN.LV1") is None
+    assert pattern.fullmatch("/data/2024/01/extra/240115_0_P10_ZEN.LV1") is None
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs inotify")
+def test_watch_submits_written_files(make_data):
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        config = get_config()
+    watcher = make_watcher(config, make_targets(config), interval=0.1)
+    submissions = watch_submissions(config, settle=0.1, watcher=watcher)
+    monthly = next(p for p in make_data if p.suffix == ".txt")
+    with monthly.open("a") as f:
+        f.write("appended\n")
+    sub = next(submissions)
+    submissions.close()
+    assert sub.path.resolve() == monthly.resolve()
+    assert sub.metadata.measurement_date.day == 1
+
+
+def test_watch_waits_for_min_age(make_data):
+    argv = ["prog", "--config", test_config_fname, "--min-age", "1"]
+    with patch("sys.argv", argv):
+        config = get_config()
+    watcher = make_watcher(config, make_targets(config), interval=0.1)
+    submissions = watch_submissions(config, settle=0.1, watcher=watcher)
+    monthly = next(p for p in make_data if p.suffix == ".txt")
+    with monthly.open("a") as f:
+        f.write("appended\n")
+    sub = next(submissions)
+    submissions.close()
+    assert sub.path.resolve() == monthly.resolve()
+    assert time.time() - monthly.stat().st_mtime >= 1
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs inotify")
+def test_watch_ignores_old_dates(make_data):
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        config = get_config()
+    old = pathlib.Path("data/mace-head/chm15k/2020/01")
+    old.mkdir(parents=True)
+    watcher = make_watcher(config, make_targets(config), interval=0.1)
+    assert isinstance(watcher, InotifyWatcher)
+    old.joinpath("20200101_MaceHead_CHM.nc").write_text("old")
+    daily = next(p for p in make_data if p.suffix == ".nc")
+    with daily.open("a") as f:
+        f.write("appended\n")
+    paths = watcher.events(1.0)
+    watcher.close()
+    assert [pathlib.Path(p).resolve() for p in paths] == [daily.resolve()]
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs inotify")
+def test_watch_polls_when_inotify_runs_out_of_watches(make_data, capsys):
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        config = get_config()
+    no_space = OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    with patch.object(InotifyWatcher, "_add", side_effect=no_space):
+        watcher = make_watcher(config, make_targets(config), interval=0.1)
+    assert isinstance(watcher, PollingWatcher)
+    assert "polling instead" in capsys.readouterr().err
+
+    class FailingWatcher:
+        overflowed = False
+
+        def events(self, timeout):
+            raise no_space
+
+        def close(self):
+            pass
+
+    submissions = watch_submissions(config, settle=0.1, watcher=FailingWatcher())
+    sub = next(submissions)
+    submissions.close()
+    assert sub.path.resolve() in {p.resolve() for p in make_data}
+    assert "polling instead" in capsys.readouterr().err
+
+
+def test_watch_rejects_shard(make_data):
+    argv = ["prog", "--config", test_config_fname, "--watch", "--shard", "1/2"]
+    with patch("sys.argv", argv), pytest.raises(SystemExit):
+        get_config()
+
+
+def test_circuit_opens_when_portal_fails(make_data, portal, capture_stdout):
+    portal.outage = 500
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    start = time.monotonic()
+    with patch("sys.argv", [*argv, "--no-preflight"]), pytest.raises(SystemExit):
+        main()
+    assert time.monotonic() - start < 5
+    assert portal.count("POST") == 5
+    assert "Data portal unavailable" in capture_stdout["stdout"]
+
+
+def test_retry_after_is_honoured(make_data, portal):
+    portal.injected.append((503, {"Retry-After": "1"}))
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    start = time.monotonic()
+    with patch("sys.argv", [*argv, "--no-preflight", "--no-cache"]):
+        main()
+    n_files = len(set(p.resolve() for p in make_data))
+    assert time.monotonic() - start >= 1
+    assert portal.count("POST") == n_files + 1
+    assert portal.count("PUT") == n_files
+
+
+def test_retry_after_on_upload_is_capped(make_data, portal, capture_stdout):
+    with open(test_config_fname, "a") as f:
+        f.write("\n[network.circuit_breaker]\nmax_retry_after = 1\n")
+    portal.injected_by_method["PUT"] = [(503, {"Retry-After": "0"})] * 3
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    with patch("sys.argv", [*argv, "--no-preflight"]), pytest.raises(SystemExit):
+        main()
+    n_files = len(set(p.resolve() for p in make_data))
+    assert portal.count("PUT") == n_files + 2
+    assert "Failed to submit 1 file." in capture_stdout["stdout"]
+
+
+def test_metrics_report(make_data, portal, tmp_path):
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    argv += ["--metrics-json", str(tmp_path / "run.json")]
+    argv += ["--metrics-textfile", str(tmp_path / "run.prom")]
+    with patch("sys.argv", [*argv, "--no-preflight", "--no-cache"]):
+        main()
+    n_files = len(set(p.resolve() for p in make_data))
+    size = sum(p.stat().st_size for p in set(p.resolve() for p in make_data))
+    report = json.loads((tmp_path / "run.json").read_text())
+    assert report["files"] == {"submitted": n_files}
+    assert report["responses"] == {
+        "metadata": {"200": n_files},
+        "data": {"201": n_files},
+    }
+    assert report["phases"]["hash"]["count"] == n_files
+    assert report["phases"]["data"]["bytes"] == size
+    assert report["sites"]["mace-head"]["scan"]["count"] > 0
+    textfile = (tmp_path / "run.prom").read_text()
+    assert f'cloudnet_submit_files{{result="submitted"}} {n_files}' in textfile
+    assert 'cloudnet_submit_phase_bytes{phase="data",site="mace-head"}' in textfile
+    assert 'cloudnet_submit_phase_bytes{phase="hash",site="mace-head"}' in textfile
+
+
+def test_metrics_count_every_retry(make_data, portal, tmp_path):
+    portal.injected_by_method["PUT"] = [(503, {"Retry-After": "0"})] * 2
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    argv += ["--metrics-json", str(tmp_path / "run.json"), "--no-preflight"]
+    with patch("sys.argv", argv):
+        main()
+    report = json.loads((tmp_path / "run.json").read_text())
+    assert report["retries"]["data"] == 2
+
+
+def test_metrics_are_written_when_interrupted(make_data, portal, tmp_path):
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    argv += ["--metrics-textfile", str(tmp_path / "run.prom"), "--no-preflight"]
+    interrupted = patch(
+        "cloudnet_submit.main.run_pipeline", side_effect=KeyboardInterrupt
+    )
+    with interrupted, patch("sys.argv", argv), pytest.raises(KeyboardInterrupt):
+        main()
+    textfile = (tmp_path / "run.prom").read_text()
+    assert "cloudnet_submit_run_duration_seconds" in textfile
+
+
+def test_parse_rate():
+    assert parse_rate("2 Mbit/s") == 250_000
+    assert parse_rate("500kB/s") == 500_000
+    assert parse_rate(1000) == 1000
+    assert parse_rate("unlimited") is None
+    with pytest.raises(ValueError):
+        parse_rate("fast")
+
+
+def test_bandwidth_profiles():
+    day = BandwidthProfile(datetime.time(6), datetime.time(20), limit=125_000)
+    config = BandwidthConfig(limit=None, profiles=[day])
+    assert config.current_limit(datetime.time(12)) == 125_000
+    assert config.current_limit(datetime.time(22)) is None
+    night = BandwidthProfile(datetime.time(22), datetime.time(4), limit=None)
+    assert night.active(datetime.time(1)) and not night.active(datetime.time(5))
+
+
+def test_bandwidth_profiles_accept_toml_times(make_test_dir_with_config):
+    with open(test_config_fname, "a") as f:
+        f.write('\n[[network.bandwidth_profile]]\nstart = 06:00:00\nend = "20:00"\n')
+        f.write('limit = "1 Mbit/s"\n')
+    with patch("sys.argv", ["prog", "--config", test_config_fname]):
+        config = get_config()
+    (profile,) = config.bandwidth.profiles
+    assert (profile.start, profile.end) == (datetime.time(6), datetime.time(20))
+
+
+def test_throttled_reader():
+    bucket = TokenBucket(lambda: 1_000_000, burst=0.01)
+    reader = ThrottledReader(io.BytesIO(b"x" * 300_000), bucket)
+    assert reader.len == 300_000
+    start = time.monotonic()
+    assert len(b"".join(reader)) == 300_000
+    assert 0.25 < time.monotonic() - start < 1.0
+
+
+def test_benchmarks(tmp_path):
+    results_path = tmp_path / "results.jsonl"
+    argv = ["--scale", "small", "--sites", "1", "--days", "1"]
+    results = run_benchmarks([*argv, "--results", str(results_path)])
+    assert [r.scenario for r in results] == [
+        "scan",
+        "validate",
+        "hash",
+        "upload",
+        "full",
+    ]
+    assert all(r.files == 5 for r in results)
+    assert load_results(results_path) == results
+
+
+def test_failed_files_are_retried_from_spool(make_data, portal, capture_stdout):
+    with open(test_config_fname, "a") as f:
+        f.write("\n[spool]\nmin_backoff = 0\n")
+    portal.injected.append((500, {}))
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    with patch("sys.argv", [*argv, "--no-preflight"]), pytest.raises(SystemExit):
+        main()
+    n_files = len(set(p.resolve() for p in make_data))
+    assert portal.count("PUT") == n_files - 1
+    assert "1 failed file will be retried on later runs" in capture_stdout["stdout"]
+    argv += ["--no-preflight", "--date", "2000-01-01"]
+    # Another data portal has its own spool.
+    other = Portal()
+    other.start()
+    try:
+        with patch("sys.argv", [*argv, "--host", other.url]):
+            main()
+    finally:
+        other.stop()
+    assert other.count("PUT") == 0
+    # Only the shard of the file retries it.
+    for shard in ("1/2", "2/2"):
+        with patch("sys.argv", [*argv, "--shard", shard]):
+            main()
+    assert portal.count("PUT") == n_files
+    assert capture_stdout["stdout"].count("Retrying 1 file that failed") == 1
+    with patch("sys.argv", argv):
+        main()
+    assert portal.count("PUT") == n_files
+
+
+def test_spool_keeps_interrupted_and_drops_rejected_files(
+    make_data, portal, capture_stdout
+):
+    with open(test_config_fname, "a") as f:
+        f.write("\n[spool]\nmin_backoff = 0\n")
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    argv += ["--no-preflight"]
+    failing = patch.object(Submission, "submit_data", side_effect=OSError("boom"))
+    with failing, patch("sys.argv", argv), pytest.raises(OSError):
+        main()
+    portal.injected.append((400, {}))
+    with patch("sys.argv", [*argv, "--date", "2000-01-01"]), pytest.raises(SystemExit):
+        main()
+    assert "Retrying 1 file that failed" in capture_stdout["stdout"]
+    assert portal.count("PUT") == 0
+    with patch("sys.argv", [*argv, "--date", "2000-01-01"]):
+        main()
+    assert capture_stdout["stdout"].count("Retrying 1 file that failed") == 1
+
+
+def test_stalled_transfer_is_aborted():
+    reader = WatchedReader(io.BytesIO(bytes(1000)), min_rate=1e6, stall_time=0.05)
+    assert reader.len == 1000
+    reader.read(100)
+    time.sleep(0.06)
+    with pytest.raises(TransferStalled):
+        reader.read(100)
+    reader.seek(0)
+    assert reader.read() == bytes(1000)
+    reader = WatchedReader(io.BytesIO(bytes(1000)), min_rate=1.0, stall_time=0.05)
+    reader.read(100)
+    time.sleep(0.06)
+    assert len(reader.read(100)) == 100
+
+
+def test_slow_portal_times_out(make_data, portal, capture_stdout):
+    with open(test_config_fname, "a") as f:
+        f.write("\n[network]\nread_timeout = 0.1\n")
+    portal.latency = 0.5
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    with patch("sys.argv", [*argv, "--no-preflight"]), pytest.raises(SystemExit):
+        main()
+    assert "Timed out" in capture_stdout["stdout"]
+    assert portal.count("PUT") == 0
+
+
+def test_slow_upload_times_out_without_retries(make_data, portal, capture_stdout):
+    with open(test_config_fname, "a") as f:
+        f.write("\n[network]\nread_timeout = 0.2\n")
+    portal.delays["PUT"] = 2.0
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    start = time.monotonic()
+    with patch("sys.argv", [*argv, "--no-preflight"]), pytest.raises(SystemExit):
+        main()
+    assert time.monotonic() - start < 5
+    assert "Timed out" in capture_stdout["stdout"]
+    assert portal.count("PUT") == portal.count("POST") > 0
+
+
+def test_stalled_upload_is_restarted(tmp_path):
+    path = tmp_path / "20240115_hyytiala_ecmwf.nc"
+    path.write_bytes(os.urandom(1000))
+    metadata = ModelMetadata(
+        site="hyytiala",
+        measurement_date=datetime.date(2024, 1, 15),
+        filename=path.name,
+        checksum=compute_checksum(path),
+        model="ecmwf",
+    )
+    timeouts = TimeoutConfig(min_rate=1.0, stall_retries=2)
+    sub = Submission(
+        path,
+        metadata,
+        ("alice", "secret"),
+        DataportalConfig("http://localhost"),
+        ProxyConfig(),
+        context=SubmissionContext(timeouts=timeouts),
+    )
+    bodies = []
+
+    class Session:
+        def put(self, url, data, **kwargs):
+            bodies.append(data.read())
+            if len(bodies) < 3:
+                raise TransferStalled("stalled")
+            return type("Response", (), {"status_code": 200, "ok": True, "text": ""})
+
+    with patch.object(Submission, "session", Session()):
+        sub.submit_data()
+        assert sub.status.data_ok
+        assert bodies == [path.read_bytes()] * 3
+        bodies.clear()
+        timeouts.stall_retries = 1
+        with pytest.raises(TransferStalled):
+            sub.submit_data()
+        assert len(bodies) == 2
+
+
+def test_deadline_stops_new_submissions(make_data, portal, capture_stdout):
+    argv = ["prog", "--config", test_config_fname, "--host", portal.url]
+    argv += ["--no-preflight", "--deadline", "0"]
+    with patch("sys.argv", argv), pytest.raises(SystemExit) as exc:
+        main()
+    assert exc.value.code == EXIT_DEADLINE
+    assert portal.count("POST") == 0
+    assert "Deadline reached, left 1 file for the next run" in capture_stdout["stdout"]
+    assert "Files not found before the deadline" in capture_stdout["stdout"]